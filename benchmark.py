@@ -0,0 +1,385 @@
+"""
+Benchmarks for the ChessGame hot paths and for !board replies
+
+Every benchmark runs over the same fixed corpus: a handful of well known
+games, plus games and positions generated from a fixed random seed. Each one
+is run once to warm up and then repeated, and every call is timed on its own
+so percentiles can be reported.
+
+Usage:
+python benchmark.py [--repeat N] [--output results.json] [--compare old.json]
+"""
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import timeit
+
+from twisted.test.proto_helpers import StringTransport
+
+import ircbot
+
+# Famous games, as someone would paste them into !board
+GAMES = [
+    # Morphy - Duke Karl / Count Isouard, Paris 1858
+    "1. e4 e5 2. Nf3 d6 3. d4 Bg4 4. dxe5 Bxf3 5. Qxf3 dxe5 6. Bc4 Nf6 7. Qb3 Qe7 8. Nc3 c6 9. Bg5 b5 10. Nxb5 cxb5 "
+    "11. Bxb5+ Nbd7 12. O-O-O Rd8 13. Rxd7 Rxd7 14. Rd1 Qe6 15. Bxd7+ Nxd7 16. Qb8+ Nxb8 17. Rd8#",
+    # Anderssen - Kieseritzky, London 1851
+    "1. e4 e5 2. f4 exf4 3. Bc4 Qh4+ 4. Kf1 b5 5. Bxb5 Nf6 6. Nf3 Qh6 7. d3 Nh5 8. Nh4 Qg5 9. Nf5 c6 10. g4 Nf6 "
+    "11. Rg1 cxb5 12. h4 Qg6 13. h5 Qg5 14. Qf3 Ng8 15. Bxf4 Qf6 16. Nc3 Bc5 17. Nd5 Qxb2 18. Bd6 Bxg1 19. e5 Qxa1+ "
+    "20. Ke2 Na6 21. Nxg7+ Kd8 22. Qf6+ Nxf6 23. Be7#",
+    # Anderssen - Dufresne, Berlin 1852
+    "1. e4 e5 2. Nf3 Nc6 3. Bc4 Bc5 4. b4 Bxb4 5. c3 Ba5 6. d4 exd4 7. O-O d3 8. Qb3 Qf6 9. e5 Qg6 10. Re1 Nge7 "
+    "11. Ba3 b5 12. Qxb5 Rb8 13. Qa4 Bb6 14. Nbd2 Bb7 15. Ne4 Qf5 16. Bxd3 Qh5 17. Nf6+ gxf6 18. exf6 Rg8 "
+    "19. Rad1 Qxf3 20. Rxe7+ Nxe7 21. Qxd7+ Kxd7 22. Bf5+ Ke8 23. Bd7+ Kf8 24. Bxe7#",
+    # D. Byrne - Fischer, New York 1956
+    "1. Nf3 Nf6 2. c4 g6 3. Nc3 Bg7 4. d4 O-O 5. Bf4 d5 6. Qb3 dxc4 7. Qxc4 c6 8. e4 Nbd7 9. Rd1 Nb6 10. Qc5 Bg4 "
+    "11. Bg5 Na4 12. Qa3 Nxc3 13. bxc3 Nxe4 14. Bxe7 Qb6 15. Bc4 Nxc3 16. Bc5 Rfe8+ 17. Kf1 Be6 18. Bxb6 Bxc4+ "
+    "19. Kg1 Ne2+ 20. Kf1 Nxd4+ 21. Kg1 Ne2+ 22. Kf1 Nc3+ 23. Kg1 axb6 24. Qb4 Ra4 25. Qxb6 Nxd1 26. h3 Rxa2 "
+    "27. Kh2 Nxf2 28. Re1 Rxe1 29. Qd8+ Bf8 30. Nxe1 Bd5 31. Nf3 Ne4 32. Qb8 b5 33. h4 h5 34. Ne5 Kg7 35. Kg1 Bc5+ "
+    "36. Kf1 Ng3+ 37. Ke1 Bb4+ 38. Kd1 Bb3+ 39. Kc1 Ne2+ 40. Kb1 Nc3+ 41. Kc1 Rc2#",
+    # Kasparov - Topalov, Wijk aan Zee 1999
+    "1. e4 d6 2. d4 Nf6 3. Nc3 g6 4. Be3 Bg7 5. Qd2 c6 6. f3 b5 7. Nge2 Nbd7 8. Bh6 Bxh6 9. Qxh6 Bb7 10. a3 e5 "
+    "11. O-O-O Qe7 12. Kb1 a6 13. Nc1 O-O-O 14. Nb3 exd4 15. Rxd4 c5 16. Rd1 Nb6 17. g3 Kb8 18. Na5 Ba8 19. Bh3 d5 "
+    "20. Qf4+ Ka7 21. Rhe1 d4 22. Nd5 Nbxd5 23. exd5 Qd6 24. Rxd4 cxd4 25. Re7+ Kb6 26. Qxd4+ Kxa5 27. b4+ Ka4 "
+    "28. Qc3 Qxd5 29. Ra7 Bb7 30. Rxb7 Qc4 31. Qxf6 Kxa3 32. Qxa6+ Kxb4 33. c3+ Kxc3 34. Qa1+ Kd2 35. Qb2+ Kd1 "
+    "36. Bf1 Rd2 37. Rd7 Rxd7 38. Bxc4 bxc4 39. Qxh8 Rd3 40. Qa8 c3 41. Qa4+ Ke1 42. f4 f5 43. Kc1 Rd2 44. Qa7",
+]
+
+RANDOM_SEED = 2016
+RANDOM_GAMES = 40
+RANDOM_PLIES = 80
+
+
+def randomGames(count, plies, seed):
+    """
+    Returns move lists of games played by picking random legal moves, the same ones for the same seed
+
+    Keyword arguments:
+    count -- how many games to play
+    plies -- the most moves in each game
+    seed  -- the random seed
+    """
+
+    rng = random.Random(seed)
+    game = ircbot.ChessGame()
+    games = []
+    for i in range(count):
+        game.setFEN(ircbot.ChessGame.fen_startpos)
+        moves = []
+        for ply in range(plies):
+            # Promotions in letter order, as when moves were (from, to, promotion) tuples, so the corpus stays
+            # the same and results can still be compared with older runs
+            legal = sorted(game.legalMoves(), key=lambda move: (move >> 4, ircbot.PIECE_CHARS[move & 15].upper()))
+            if not legal:
+                break
+            move = rng.choice(legal)
+            fr, to, promotion = ircbot.unpackMove(move)
+            if game.board[fr] & 7 == ircbot.KING and abs((to & 7) - (fr & 7)) == 2:
+                # moveParse only knows castling as O-O and O-O-O
+                moves.append("O-O" if to & 7 == 6 else "O-O-O")
+            else:
+                moves.append(game.moveToStr(move))
+            game.push(move)
+        games.append(" ".join(moves))
+    return games
+
+
+def buildCorpus():
+    """
+    Returns the move lists and FENs every benchmark runs over. The FENs are every position reached in the games
+    plus the perft reference positions
+
+    Keyword arguments:
+    """
+
+    games = GAMES + randomGames(RANDOM_GAMES, RANDOM_PLIES, RANDOM_SEED)
+    fens = [fen for fen, counts in ircbot.PERFT_POSITIONS]
+    game = ircbot.ChessGame()
+    for moves in games:
+        game.setFEN(ircbot.ChessGame.fen_startpos)
+        for a in game.moveSplit(moves):
+            if game.push(a) == False:
+                raise ValueError("Corpus move {} doesn't parse in {}".format(a, moves))
+            game.getFEN()
+            fens.append(game.fen)
+    return games, fens
+
+
+def summarize(samples):
+    """
+    Returns the count and the timing percentiles of a list of samples, in microseconds
+
+    Keyword arguments:
+    samples -- the time each call took, in seconds
+    """
+
+    samples = sorted(samples)
+    n = len(samples)
+
+    def percentile(p):
+        return samples[min(n - 1, int(p / 100.0 * n))] * 1e6
+
+    return {
+        "n": n,
+        "mean": sum(samples) / n * 1e6,
+        "min": samples[0] * 1e6,
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": samples[-1] * 1e6,
+    }
+
+
+def timeCalls(func, inputs, samples):
+    """
+    Calls func on each input, appending the time each call took to samples
+
+    Keyword arguments:
+    func    -- the function to time
+    inputs  -- the arguments to call it with, one at a time
+    samples -- the list to add the timings to
+    """
+
+    timer = timeit.default_timer
+    for a in inputs:
+        start = timer()
+        func(a)
+        samples.append(timer() - start)
+
+
+def benchSetFEN(games, fens):
+    game = ircbot.ChessGame()
+    return game.setFEN, fens
+
+
+def benchGetFEN(games, fens):
+    game = ircbot.ChessGame()
+    snapshots = []
+    for fen in fens:
+        game.setFEN(fen)
+        snapshots.append(game.snapshot())
+
+    def run(snapshot):
+        game.restore(snapshot)
+        game.getFEN()
+
+    return run, snapshots
+
+
+def benchMoveParse(games, fens):
+    """
+    Times parsing and playing single moves, with the position before each move set up outside the timing
+    """
+
+    game = ircbot.ChessGame()
+    cases = []
+    for moves in games:
+        game.setFEN(ircbot.ChessGame.fen_startpos)
+        for a in game.moveSplit(moves):
+            cases.append((game.snapshot(), a))
+            game.push(a)
+
+    timer = timeit.default_timer
+
+    def run(samples):
+        for snapshot, a in cases:
+            game.restore(snapshot)
+            start = timer()
+            game.push(a)
+            samples.append(timer() - start)
+
+    return run
+
+
+def benchSANRoundTrip(games, fens):
+    """
+    Times finding each move of the corpus, writing it in SAN, and parsing the SAN back, which has to give the same
+    move
+    """
+
+    game = ircbot.ChessGame()
+    cases = []
+    for moves in games:
+        game.setFEN(ircbot.ChessGame.fen_startpos)
+        for a in game.moveSplit(moves):
+            cases.append((game.snapshot(), a))
+            game.push(a)
+
+    timer = timeit.default_timer
+
+    def run(samples):
+        for snapshot, a in cases:
+            game.restore(snapshot)
+            start = timer()
+            move = game.moveFind(a)
+            san = game.moveToSAN(move)
+            if game.moveFind(san) != move:
+                raise ValueError("{} was written as {}, which doesn't parse back to the same move".format(a, san))
+            samples.append(timer() - start)
+
+    return run
+
+
+def benchAttacks(games, fens):
+    game = ircbot.ChessGame()
+    snapshots = []
+    for fen in fens:
+        game.setFEN(fen)
+        snapshots.append(game.snapshot())
+    timer = timeit.default_timer
+
+    def run(samples):
+        # One sample is every square checked for both colours in one position
+        for snapshot in snapshots:
+            game.restore(snapshot)
+            start = timer()
+            for row in range(8):
+                for col in range(8):
+                    game.isWhiteAttacking(col, row)
+                    game.isBlackAttacking(col, row)
+            samples.append(timer() - start)
+
+    return run
+
+
+def benchLichessURL(games, fens):
+    game = ircbot.ChessGame()
+    return game.getLichessURL, games
+
+
+def benchLichessURLCached(games, fens):
+    game = ircbot.ChessGame()
+    cache = ircbot.MoveCache()
+    return lambda moves: game.getLichessURL(moves, cache), games
+
+
+def benchPrivmsg(games, fens):
+    """
+    Times a !board message going through privmsg until its reply has been written to the transport
+    """
+
+    class Protocol(ircbot.ChessBotIRCProtocol):
+        # Nothing should be held back by flood control or rate limits here
+        sendBurst = userBurst = channelBurst = 10 ** 9
+        userRate = channelRate = sendRate = 10 ** 9
+
+    protocol = Protocol()
+    protocol.factory = ircbot.ChessIRCFactory()
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    transport.clear()
+    timer = timeit.default_timer
+
+    def run(samples):
+        for moves in games:
+            start = timer()
+            protocol.privmsg("bench!bench@example.org", "##chess", "!board " + moves)
+            if not transport.value():
+                raise ValueError("No reply for !board {}".format(moves))
+            samples.append(timer() - start)
+            transport.clear()
+
+    return run
+
+
+# name ---> setup function. A setup returns either (func, inputs) to time func on each input, or a function that
+# takes the list of samples and does its own timing
+BENCHMARKS = [
+    ("setFEN", benchSetFEN),
+    ("getFEN", benchGetFEN),
+    ("moveParse", benchMoveParse),
+    ("san.roundtrip", benchSANRoundTrip),
+    ("attacks", benchAttacks),
+    ("getLichessURL", benchLichessURL),
+    ("getLichessURL.cached", benchLichessURLCached),
+    ("privmsg.board", benchPrivmsg),
+]
+
+
+def runBenchmarks(repeat, only=None):
+    """
+    Runs every benchmark once to warm up and then repeat times, returning the summary of each
+
+    Keyword arguments:
+    repeat -- how many timed runs to do
+    only   -- a list of benchmark names to run, or None for all of them
+    """
+
+    games, fens = buildCorpus()
+    results = {}
+    for name, setup in BENCHMARKS:
+        if only and name not in only:
+            continue
+        bench = setup(games, fens)
+        if isinstance(bench, tuple):
+            func, inputs = bench
+            run = lambda samples: timeCalls(func, inputs, samples)
+        else:
+            run = bench
+
+        run([])
+        samples = []
+        for i in range(repeat):
+            run(samples)
+        results[name] = summarize(samples)
+        sys.stderr.write("{:<22} {:>8.1f} us p50 {:>8.1f} us p99\n".format(name, results[name]["p50"], results[name]["p99"]))
+    return results
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    """
+    Prints how each benchmark's median changed against an earlier JSON output
+
+    Keyword arguments:
+    results -- the summaries from this run
+    path    -- the JSON file written by an earlier run
+    """
+
+    with open(path) as f:
+        old = json.load(f)["benchmarks"]
+    for name in sorted(results):
+        if name not in old:
+            continue
+        before = old[name]["p50"]
+        after = results[name]["p50"]
+        print("{:<22} {:>8.1f} us -> {:>8.1f} us  {:+.1f}%".format(name, before, after, (after / before - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the ChessGame hot paths and !board replies")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of each benchmark (default 5)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="print changes against the JSON written by an earlier run")
+    parser.add_argument("benchmarks", nargs="*", help="names of the benchmarks to run (default all)")
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.repeat, args.benchmarks)
+    output = {
+        "commit": gitCommit(),
+        "python": platform.python_version(),
+        "repeat": args.repeat,
+        "benchmarks": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+    elif not args.output:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
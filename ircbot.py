@@ -1,17 +1,240 @@
+import collections
+import cProfile
+import itertools
+import multiprocessing
+import os
+import random
+import re
+import signal
+import struct
 import sys
-import urllib2
+import time
+import urllib
 import json
 
 from twisted.internet import defer, endpoints, protocol, reactor, task
-from twisted.python import log
+from twisted.python import failure, log
+from twisted.web import server
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone, ResponseFailed, ResponseNeverReceived, readBody
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
 from twisted.words.protocols import irc
 
+from metrics import Metrics, MetricsResource
+import openings
+import pgn
+
+
+# Piece codes stored in the board array. The low three bits give the piece
+# type and bit 3 is set for black pieces, so an empty square is simply 0.
+EMPTY = 0
+PAWN = 1
+KNIGHT = 2
+BISHOP = 3
+ROOK = 4
+QUEEN = 5
+KING = 6
+BLACK = 8
+
+# Piece code <---> FEN character
+PIECE_CHARS = "-PNBRQK--pnbrqk-"
+PIECE_CODES = {"-": EMPTY}
+for _code, _char in enumerate(PIECE_CHARS):
+    if _char != "-":
+        PIECE_CODES[_char] = _code
+
+# FEN tables. A rank is expanded by replacing each digit with that many
+# "-" once the placement has been checked for stray characters, and converted with one
+# translate() through a 256 character table in either direction
+FEN_DIGITS = [(str(_n), "-" * _n) for _n in range(1, 9)]
+FEN_PLACEMENT_CHARS = "PNBRQKpnbrqk12345678/"
+FEN_TO_CODES = "".join(chr(PIECE_CODES.get(chr(_c), EMPTY)) for _c in range(256))
+CODES_TO_FEN = PIECE_CHARS.ljust(256, "-")
+# Castling right ---> (the expanded rank it's on, counting from rank 8 as a
+# FEN does, the king and rook that have to be there, the rook's column)
+FEN_CASTLING = {"K": (7, "K", "R", 7), "Q": (7, "K", "R", 0), "k": (0, "k", "r", 7), "q": (0, "k", "r", 0)}
+# 8 byte board row ---> FEN rank, filled in as rows are seen
+FEN_RANKS = {}
+FEN_RANKS_MAX = 65536
+
+def fenRank(row):
+    """
+    Returns the FEN rank for one row of 8 piece codes, e.g. "rnbqkbnr" or "3p4"
+    
+    Keyword arguments:
+    row -- the row as a string of 8 piece codes
+    """
+    
+    rank = FEN_RANKS.get(row)
+    if rank is None:
+        rank = row.translate(CODES_TO_FEN)
+        # Longest runs first so "--" inside "----" isn't turned into "22"
+        for digit, run in reversed(FEN_DIGITS):
+            rank = rank.replace(run, digit)
+        if len(FEN_RANKS) >= FEN_RANKS_MAX:
+            FEN_RANKS.clear()
+        FEN_RANKS[row] = rank
+    return rank
+
+# Square offsets on the 0x88 board, in the order the findMove* helpers have
+# always searched them (that order decides which piece wins an ambiguous move)
+KNIGHT_OFFSETS = (31, 33, -33, -31, 18, -14, 14, -18)
+DIAGONAL_OFFSETS = (17, 15, -15, -17)
+STRAIGHT_OFFSETS = (1, -1, 16, -16)
+KING_OFFSETS = (16, -16, 1, -1, 17, 15, -15, -17)
+
+# The step to walk from one square towards another, indexed by (to - from + 119),
+# or 0 if they don't share a row, column or diagonal. Every multiple of an offset
+# up to 7 is a different difference on the 0x88 board, so one list covers them all
+RAY_STEPS = [0] * 239
+for _offset in DIAGONAL_OFFSETS + STRAIGHT_OFFSETS:
+    for _n in range(1, 8):
+        RAY_STEPS[_offset*_n + 119] = _offset
+
+def _stepTargets(sq, offsets):
+    """
+    Returns the squares one step from sq by each offset that are on the board, in the order of the offsets
+    
+    Keyword arguments:
+    sq      -- the 0x88 square to step from
+    offsets -- the 0x88 offsets to step by
+    """
+    
+    return tuple(sq + offset for offset in offsets if not (sq + offset) & 0x88)
+
+def _rayTargets(sq, offsets):
+    """
+    Returns a tuple of squares for each direction from sq, nearest first, leaving out directions that go straight
+    off the board
+    
+    Keyword arguments:
+    sq      -- the 0x88 square the rays start from
+    offsets -- the 0x88 directions to walk
+    """
+    
+    rays = []
+    for offset in offsets:
+        ray = []
+        to = sq + offset
+        while not to & 0x88:
+            ray.append(to)
+            to += offset
+        if ray != []:
+            rays.append(tuple(ray))
+    return tuple(rays)
+
+# Lookup tables indexed by 0x88 square, built once so the move finders and
+# attack tests never work out coordinates. Padding squares get empty tuples.
+# Every table keeps the order of the offsets it was built from.
+_SQUARES = [sq for sq in range(128) if not sq & 0x88]
+KNIGHT_TARGETS = [()] * 128
+KING_TARGETS = [()] * 128
+DIAGONAL_RAYS = [()] * 128
+STRAIGHT_RAYS = [()] * 128
+# The squares a pawn of each colour attacks a square from, indexed by colour >> 3
+PAWN_ATTACKERS = ([()] * 128, [()] * 128)
+for _sq in _SQUARES:
+    KNIGHT_TARGETS[_sq] = _stepTargets(_sq, KNIGHT_OFFSETS)
+    KING_TARGETS[_sq] = _stepTargets(_sq, KING_OFFSETS)
+    DIAGONAL_RAYS[_sq] = _rayTargets(_sq, DIAGONAL_OFFSETS)
+    STRAIGHT_RAYS[_sq] = _rayTargets(_sq, STRAIGHT_OFFSETS)
+    PAWN_ATTACKERS[0][_sq] = _stepTargets(_sq, (-17, -15))
+    PAWN_ATTACKERS[1][_sq] = _stepTargets(_sq, (15, 17))
+
+# Zobrist keys: a random 64 bit number for every piece code on every 0x88
+# square, each castling right, each ep column and black to move. A position's
+# key is the XOR of the numbers for everything in it. The generator is seeded
+# so keys are the same from run to run.
+_zobrist_random = random.Random(0x88)
+ZOBRIST_PIECES = [[0]*128 if PIECE_CHARS[_code] == "-" else [_zobrist_random.getrandbits(64) for _sq in range(128)]
+                  for _code in range(16)]
+ZOBRIST_CASTLING = dict((_char, _zobrist_random.getrandbits(64)) for _char in "KQkq")
+ZOBRIST_EP = [_zobrist_random.getrandbits(64) for _col in range(8)]
+ZOBRIST_BLACK = _zobrist_random.getrandbits(64)
+
+# The first square of each row of the 0x88 board, bottom row first
+ROW_STARTS = (0, 16, 32, 48, 64, 80, 96, 112)
+
+def packMove(fr, to, promotion=EMPTY):
+    """
+    Returns a move packed into one int, the way pseudoMoves() and legalMoves() give them. Packed moves sort by
+    from square, then to square, then promotion
+    
+    Keyword arguments:
+    fr        -- the 0x88 square the piece is moving from
+    to        -- the 0x88 square the piece is moving to
+    promotion -- the piece code promoted to, EMPTY for none
+    """
+    
+    return fr << 11 | to << 4 | promotion
+
+def unpackMove(move):
+    """
+    Returns the (from, to, promotion) of a packed move
+    
+    Keyword arguments:
+    move -- the move, from packMove()
+    """
+    
+    return move >> 11, move >> 4 & 127, move & 15
+
+
+class Position(object):
+    """
+    A position saved by ChessGame.snapshot(). Only the 64 squares on the board are kept, and slots leave out the
+    dict every other object carries, so a cached position costs a couple of hundred bytes
+    """
+    
+    __slots__ = ("board", "turn", "castling", "ep", "fiftyMoves", "fullMoves", "zobrist", "opening")
+    
+    def __init__(self, board, turn, castling, ep, fiftyMoves, fullMoves, zobrist, opening=None):
+        """
+        Keyword arguments:
+        board      -- the 64 piece codes from A1 to H8, a row at a time
+        turn       -- "w" or "b"
+        castling   -- the castling rights, as in a FEN
+        ep         -- the ep square, or "-"
+        fiftyMoves -- halfmoves since the last capture or pawn advance
+        fullMoves  -- the full move number
+        zobrist    -- the Zobrist key of the position
+        opening    -- the (ECO, name) of the opening the game reached on the way here, or None
+        """
+        
+        self.board = board
+        self.turn = turn
+        self.castling = castling
+        self.ep = ep
+        self.fiftyMoves = fiftyMoves
+        self.fullMoves = fullMoves
+        self.zobrist = zobrist
+        self.opening = opening
+
 
 class ChessGame(object):
     fen_startpos = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
     
+    # Recently parsed FEN ---> snapshot(), shared by every game, least recently used first
+    fenCache = collections.OrderedDict()
+    fenCacheSize = 256
+    
     def __init__(self):
-        self.board = [["#"]*12 for i in range(12)]
+        self.board = bytearray(128)
+        # 0x88 square of each king and the set of squares holding each side's
+        # pieces, indexed by colour (0 for white, 1 for black)
+        self.kings = [-1, -1]
+        self.pieceLists = [set(), set()]
+        # Undo records for the moves played with push(), and the squares
+        # changed by the move currently being pushed
+        self.history = []
+        self.changes = None
+        # Zobrist key of the current position, see hashPosition()
+        self.zobrist = 0
+        # (zobrist, checkers, pins, evasions) for the last position checkInfo() looked at
+        self.checks = None
+        # OpeningBook looked up after each move of a move list, and the
+        # (ECO, name) of the last book position the game went through
+        self.book = None
+        self.opening = None
         self.turn = "-"
         self.castling = "-"
         self.ep = "-"
@@ -21,29 +244,46 @@ class ChessGame(object):
         self.setFEN(ChessGame.fen_startpos)
         
         # Board setup
+        # The board is a flat 0x88 array: the square index is row * 16 + col,
+        # and the right hand 8 columns of every row are unused padding. Any
+        # index with a bit of 0x88 set is off the board, which lets us walk
+        # off an edge and notice with a single AND.
+        #
         #            x & y Coordinates       Absolute coordinates
-        #            in 8x8   in 12x12       in 8x8     in 12x12
-        # A1    -    (0, 0)   (2, 2)     -   0          26
-        # E1    -    (4, 0)   (6, 2)     -   4          30
-        # E4    -    (4, 3)   (6, 5)     -   28         66
+        #            in 8x8                  in 8x8     in 0x88
+        # A1    -    (0, 0)              -   0          0
+        # E1    -    (4, 0)              -   4          4
+        # E4    -    (4, 3)              -   28         52
         #
-        # Converting x & y coordinates in 8x8 to 12x12
-        # x_8 = x_12 - 2
-        # y_8 = y_12 - 2
+        # Converting x & y coordinates in 8x8 to 0x88
+        # sq = y * 16 + x
         #
-        # Converting absolute coordinates in 8x8 to x & y coordinates in 8x8
-        # x_8 = sq % 8
-        # y_8 = sq / 8
+        # Converting 0x88 to x & y coordinates in 8x8
+        # x = sq & 7
+        # y = sq >> 4
         #
     
     def setFEN(self, fen):
         """
-        Converts a FEN string into a board position
+        Converts a FEN string into a board position. An invalid FEN leaves the position untouched
         
         Keyword arguments:
         fen -- the board position in FEN notation
         """
         
+        if isinstance(fen, unicode):
+            # The rank tables work on byte strings, and a valid FEN is all ASCII
+            try:
+                fen = fen.encode("ascii")
+            except UnicodeEncodeError:
+                return False
+        
+        snapshot = ChessGame.fenCache.pop(fen, None)
+        if snapshot is not None:
+            ChessGame.fenCache[fen] = snapshot
+            self.restore(snapshot)
+            return True
+        
         parts = fen.split(" ")
         
         if parts[0].count("/") != 7:
@@ -53,55 +293,62 @@ class ChessGame(object):
         if parts[0].count("k") != 1:
             return False
         
-        # Starting at A8, moving right, then coming down a row
-        sq = 56
-        for a in range(0, len(parts[0])):
-            if parts[0][a].isalpha():
-                if "pbnrqkPBNRQK".find(parts[0][a]) < 0:
-                    return False
-                self.boardSet(sq%8, sq/8, parts[0][a])
-                sq += 1
-            elif parts[0][a] == "/":
-                # -8 to get to the row beneath in the same column
-                # -7 to get from the 8th column to the 1st column
-                # -1 to account for sq currently being in the 9th (i) column
-                sq -= 16
-            else:
-                # We need to fill in empty spaces according to the number provided
-                for b in range(0, int(parts[0][a])):
-                    self.boardSet(sq%8+b, sq/8, "-")
-                sq += int(parts[0][a])
+        placement = parts[0]
+        if placement.translate(None, FEN_PLACEMENT_CHARS) != "":
+            return False
+        for digit, run in FEN_DIGITS:
+            placement = placement.replace(digit, run)
+        ranks = placement.split("/")
+        for rank in ranks:
+            if len(rank) != 8:
+                return False
+        # Pawns never stand on the first or last rank, and move generation steps off the board if one does
+        if ranks[0].translate(None, "Pp") != ranks[0] or ranks[7].translate(None, "Pp") != ranks[7]:
+            return False
         
         # Side to play
-        if len(parts) >= 1:
-            if parts[1] == "w":
-                self.turn = "w"
-            elif parts[1] == "b":
-                self.turn = "b"
-            else:
-                return False;
+        if len(parts) < 2 or parts[1] not in ("w", "b"):
+            return False
         
-        # Castling
-        if len(parts) >= 2:
-            self.castling = parts[2]
+        # Castling, ep square, halfmoves since last capture or pawn advance
+        # and full moves, which can be left off the end
+        parts += ["-", "-", "0", "1"][len(parts)-2:]
+        if parts[2] != "-":
+            # Each right needs its king and rook still at home
+            for right in parts[2]:
+                if right not in FEN_CASTLING:
+                    return False
+                rank, king, rook, col = FEN_CASTLING[right]
+                if ranks[rank][4] != king or ranks[rank][col] != rook:
+                    return False
+        # The ep square is behind a pawn that has just moved two squares
+        if parts[3] != "-" and (self.onBoard(parts[3]) == False or parts[3][1] != ("6" if parts[1] == "w" else "3")):
+            return False
+        if not parts[4].isdigit() or not parts[5].isdigit():
+            return False
         
-        # ep square
-        if len(parts) >= 3:
-            self.ep = parts[3]
-            if self.ep != "-" and self.onBoard(self.ep) == False:
-                return False
+        # Starting at A8 and coming down a row at a time
+        board = self.board
+        sq = 112
+        for rank in ranks:
+            board[sq:sq+8] = rank.translate(FEN_TO_CODES)
+            sq -= 16
         
-        # Halfmoves since last capture or pawn advance
-        if len(parts) >= 4:
-            self.fiftyMoves = int(parts[4])
-            if self.fiftyMoves < 0:
-                return False
+        self.indexPieces()
+        self.history = []
         
-        # Full moves
-        if len(parts) >= 5:
-            self.fullMoves = int(parts[5])
-            if self.fullMoves < 0:
-                return False
+        self.turn = parts[1]
+        self.castling = parts[2]
+        self.ep = parts[3]
+        self.fiftyMoves = int(parts[4])
+        self.fullMoves = int(parts[5])
+        
+        self.zobrist = self.hashPosition()
+        self.opening = None
+        
+        ChessGame.fenCache[fen] = self.snapshot()
+        if len(ChessGame.fenCache) > ChessGame.fenCacheSize:
+            ChessGame.fenCache.popitem(last=False)
         
         return True
     
@@ -112,49 +359,36 @@ class ChessGame(object):
         Keyword arguments:
         """
         
-        self.fen = ""
+        # Each row of the board from the 8th down, as a string of piece codes
+        board = bytes(self.board)
+        ranks = [fenRank(board[sq:sq+8]) for sq in (112, 96, 80, 64, 48, 32, 16, 0)]
         
-        # Iterate through the board
-        spaces = 0
-        for y in range(0, 8):
-            for x in range(0, 8):
-                piece = self.boardGet(x, 7-y)
-                if piece == "-":
-                    spaces += 1
-                else:
-                    if spaces > 0:
-                        self.fen += str(spaces)
-                        spaces = 0
-                    self.fen += piece
-            if spaces > 0:
-                self.fen += str(spaces)
-                spaces = 0
-            if y < 7:
-                self.fen += "/"
-        
-        self.fen += " " + self.turn
-        self.fen += " " + self.castling
-        self.fen += " " + self.ep
-        self.fen += " " + str(self.fiftyMoves)
-        self.fen += " " + str(self.fullMoves)
+        self.fen = " ".join(("/".join(ranks), self.turn, self.castling, self.ep, str(self.fiftyMoves), str(self.fullMoves)))
         
         return True
     
-    def getLichessURL(self, moves):
+    def getLichessURL(self, moves, cache=None, san=None):
         """
         Resets the board to the starting position, plays the moves given, and returns an URL to the position on Lichess.org
         
         Keyword arguments:
         moves -- the list of moves to be played
+        cache -- a MoveCache to resume from when the moves start the same way as an earlier list
+        san   -- a list to add each move played to in SAN, or None
         """
         
-        r = self.setFEN(ChessGame.fen_startpos)
-        if r == False:
-            return False
-        
-        r = self.moveParses(moves)
-        if r == False:
-            return False
+        if cache is not None:
+            r = cache.play(self, moves, san)
+            if r == False:
+                return False
+        else:
+            r = self.setFEN(ChessGame.fen_startpos)
+            if r == False:
+                return False
+            
+            r = self.moveParses(moves, san)
+            if r == False:
+                return False
         
         r = self.getFEN()
         if r == False:
@@ -163,6 +397,15 @@ class ChessGame(object):
         #if self.fen == ChessGame.fen_startpos):
         #    return False
         
+        return self.analysisURL()
+    
+    def analysisURL(self):
+        """
+        Returns the URL of an analysis board on Lichess.org for the FEN last stored in self.fen
+        
+        Keyword arguments:
+        """
+        
         return "http://lichess.org/analysis/{}".format(self.fen.replace(" ", "_"))
 
     def printBoard(self):
@@ -232,7 +475,10 @@ class ChessGame(object):
         row -- the row requested
         """
         
-        return self.board[col+2][row+2]
+        sq = (row << 4) + col
+        if sq & 0x88:
+            return "#"
+        return PIECE_CHARS[self.board[sq]]
     
     def boardSet(self, col, row, piece):
         """
@@ -244,252 +490,305 @@ class ChessGame(object):
         piece -- the piece to place at position (col, row)
         """
         
-        self.board[col+2][row+2] = piece
+        self.squareSet((row << 4) + col, PIECE_CODES[piece])
+    
+    def squareSet(self, sq, piece):
+        """
+        Sets the piece code on a 0x88 square, keeping the king squares and piece lists up to date
+        
+        Keyword arguments:
+        sq    -- the 0x88 square to change
+        piece -- the piece code to place on the square
+        """
+        
+        old = self.board[sq]
+        if self.changes is not None:
+            self.changes.append((sq, old))
+        self.zobrist ^= ZOBRIST_PIECES[old][sq] ^ ZOBRIST_PIECES[piece][sq]
+        if old != EMPTY:
+            self.pieceLists[old >> 3].discard(sq)
+            if old & 7 == KING and self.kings[old >> 3] == sq:
+                self.kings[old >> 3] = -1
+        if piece != EMPTY:
+            self.pieceLists[piece >> 3].add(sq)
+            if piece & 7 == KING:
+                self.kings[piece >> 3] = sq
+        self.board[sq] = piece
+    
+    def hashPosition(self):
+        """
+        Returns the Zobrist key of the current position, calculated from scratch. moveMake keeps self.zobrist equal
+        to this as moves are played
+        
+        Keyword arguments:
+        """
+        
+        board = self.board
+        key = 0
+        for row in range(0, 8):
+            for sq in range(row << 4, (row << 4) + 8):
+                key ^= ZOBRIST_PIECES[board[sq]][sq]
+        
+        key ^= self.castlingHash(self.castling)
+        key ^= self.epHash(self.ep)
+        if self.turn == "b":
+            key ^= ZOBRIST_BLACK
+        
+        return key
+    
+    def castlingHash(self, castling):
+        """
+        Returns the part of the Zobrist key for the castling permissions given
+        
+        Keyword arguments:
+        castling -- the castling permissions in FEN notation e.g. "KQkq"
+        """
+        
+        key = 0
+        for a in castling:
+            key ^= ZOBRIST_CASTLING.get(a, 0)
+        return key
+    
+    def epHash(self, ep):
+        """
+        Returns the part of the Zobrist key for the ep square given
+        
+        Keyword arguments:
+        ep -- the ep square in algebraic notation, or "-" for none
+        """
+        
+        if ep == "-":
+            return 0
+        return ZOBRIST_EP[self.posGetCol(ep) & 7]
+    
+    def openingKey(self):
+        """
+        Returns the key the current position has in an opening book: the Zobrist key without the ep square, so an
+        opening reached by moving its pawns in a different order is still found
+        
+        Keyword arguments:
+        """
+        
+        return self.zobrist ^ self.epHash(self.ep)
+    
+    def findOpening(self):
+        """
+        Names the opening the game is in after the position just reached, if that position is in the book. Positions
+        further into the game than the book's longest line can't be in it and aren't looked up
+        
+        Keyword arguments:
+        """
+        
+        book = self.book
+        if book is None or self.fullMoves*2 - (2 if self.turn == "w" else 1) > book.depth:
+            return
+        
+        opening = book.find(self.openingKey())
+        if opening is not None:
+            self.opening = opening
+    
+    def indexPieces(self):
+        """
+        Rebuilds the king squares and piece lists from scratch after the whole board has been replaced
+        
+        Keyword arguments:
+        """
+        
+        board = self.board
+        self.kings = [-1, -1]
+        self.pieceLists = [set(), set()]
+        for row in range(0, 8):
+            for sq in range(row << 4, (row << 4) + 8):
+                piece = board[sq]
+                if piece != EMPTY:
+                    self.pieceLists[piece >> 3].add(sq)
+                    if piece & 7 == KING:
+                        self.kings[piece >> 3] = sq
     
     def findMoveWP(self, col_to, row_to):
         """
-        Returns a list of white pawn moves to position(col_to, row_to)
+        Returns a list of the squares white pawns can move to position(col_to, row_to) from
         
         Keyword arguments:
         col_to -- the column the piece is moving to
         row_to -- the row the piece is moving to
         """
         
+        board = self.board
+        to = (row_to << 4) + col_to
+        target = board[to]
+        
         # If a white piece is already at the end position, nothing can move there
-        if self.boardGet(col_to, row_to) != "-":
-            if "PBNRQK".find(self.boardGet(col_to, row_to)) >= 0:
-                return []
+        if target != EMPTY and not target & BLACK:
+            return []
         
         results = []
         
-        # ep
-        if self.posGetCol(self.ep) == col_to and self.posGetRow(self.ep) == row_to:
-            # Down 1 left 1
-            if self.boardGet(col_to-1, row_to-1) == "P":
-                results.append(["P", col_to-1, row_to-1])
-            
-            # Down 1 right 1
-            if self.boardGet(col_to+1, row_to-1) == "P":
-                results.append(["P", col_to+1, row_to-1])
-        
-        # Captures
-        if "pnbrqk".find(self.boardGet(col_to, row_to)) >= 0:
-            # Down 1 left 1
-            if self.boardGet(col_to-1, row_to-1) == "P":
-                results.append(["P", col_to-1, row_to-1])
-            
-            # Down 1 right 1
-            if self.boardGet(col_to+1, row_to-1) == "P":
-                results.append(["P", col_to+1, row_to-1])
+        # Captures, including ep
+        if target & BLACK or (self.posGetCol(self.ep) == col_to and self.posGetRow(self.ep) == row_to):
+            # Down 1 left 1, then down 1 right 1
+            for sq in PAWN_ATTACKERS[0][to]:
+                if board[sq] == PAWN:
+                    results.append(sq)
+        
+        # Pawns only capture diagonally
+        if target != EMPTY:
+            return results
         
         # Down 1
-        if self.boardGet(col_to, row_to-1) == "P":
-            results.append(["P", col_to, row_to-1])
+        if not (to-16) & 0x88 and board[to-16] == PAWN:
+            results.append(to-16)
         
         # Down 2
-        if self.boardGet(col_to, row_to-2) == "P" and row_to == 3:
+        if row_to == 3 and board[to-32] == PAWN:
             # Down 1
-            if self.boardGet(col_to, row_to-1) == "-":
-                results.append(["P", col_to, row_to-2])
+            if board[to-16] == EMPTY:
+                results.append(to-32)
         
         return results
     
     def findMoveBP(self, col_to, row_to):
         """
-        Returns a list of black pawn moves to position(col_to, row_to)
+        Returns a list of the squares black pawns can move to position(col_to, row_to) from
         
         Keyword arguments:
         col_to -- the column the piece is moving to
         row_to -- the row the piece is moving to
         """
         
+        board = self.board
+        to = (row_to << 4) + col_to
+        target = board[to]
+        
         # If a black piece is already at the end position, nothing can move there
-        if self.boardGet(col_to, row_to) != "-":
-            if "pnbrqk".find(self.boardGet(col_to, row_to)) >= 0:
-                return []
+        if target & BLACK:
+            return []
         
         results = []
         
-        # ep
-        if self.posGetCol(self.ep) == col_to and self.posGetRow(self.ep) == row_to:
-            # Up 1 left 1
-            if self.boardGet(col_to-1, row_to+1) == "p":
-                results.append(["p", col_to-1, row_to+1])
-            
-            # Up 1 right 1
-            if self.boardGet(col_to+1, row_to+1) == "p":
-                results.append(["p", col_to+1, row_to+1])
-        
-        # Captures
-        if "PNBRQK".find(self.boardGet(col_to, row_to)) >= 0:
-          # Up 1 left 1
-          if self.boardGet(col_to-1, row_to+1) == "p":
-              results.append(["p", col_to-1, row_to+1])
-          
-          # Up 1 right 1
-          if self.boardGet(col_to+1, row_to+1) == "p":
-              results.append(["p", col_to+1, row_to+1])
+        # Captures, including ep
+        if target != EMPTY or (self.posGetCol(self.ep) == col_to and self.posGetRow(self.ep) == row_to):
+            # Up 1 left 1, then up 1 right 1
+            for sq in PAWN_ATTACKERS[1][to]:
+                if board[sq] == BLACK|PAWN:
+                    results.append(sq)
+        
+        # Pawns only capture diagonally
+        if target != EMPTY:
+            return results
         
         # Up 1
-        if self.boardGet(col_to, row_to+1) == "p":
-            results.append(["p", col_to, row_to+1])
+        if not (to+16) & 0x88 and board[to+16] == BLACK|PAWN:
+            results.append(to+16)
         
         # Up 2
-        if self.boardGet(col_to, row_to+2) == "p" and row_to == 4:
+        if row_to == 4 and board[to+32] == BLACK|PAWN:
             # Up 1
-            if self.boardGet(col_to, row_to+1) == "-":
-                results.append(["p", col_to, row_to+2])
+            if board[to+16] == EMPTY:
+                results.append(to+32)
         
         return results
     
-    def findMoveN(self, piece, col_to, row_to):
+    def findMoveStep(self, piece, col_to, row_to, targets):
         """
-        Returns a list of knight moves to position(col_to, row_to)
+        Returns a list of the squares single step pieces (knights or kings) can move to position(col_to, row_to) from
         
         Keyword arguments:
-        piece  -- the type of piece: "N" for white, "n" for black
-        col_to -- the column the piece is moving to
-        row_to -- the row the piece is moving to
+        piece   -- the type of piece, upper case for white and lower case for black
+        col_to  -- the column the piece is moving to
+        row_to  -- the row the piece is moving to
+        targets -- the table of squares one step away, KNIGHT_TARGETS or KING_TARGETS
         """
         
-        if self.boardGet(col_to, row_to) != "-":
-            if piece == "N":
-                # If a black piece is already at the end position, nothing can move there
-                if "PBNRQK".find(self.boardGet(col_to, row_to)) >= 0:
-                    return []
-            elif piece == "n":
-                # If a black piece is already at the end position, nothing can move there
-                if "pbnrqk".find(self.boardGet(col_to, row_to)) >= 0:
-                    return []
+        code = PIECE_CODES[piece]
+        board = self.board
+        to = (row_to << 4) + col_to
+        target = board[to]
+        
+        # If one of our own pieces is already at the end position, nothing can move there
+        if target != EMPTY and target & BLACK == code & BLACK:
+            return []
         
         results = []
         
-        if self.boardGet(col_to-1, row_to+2) == piece: # Up 2 left 1
-            results.append([piece, col_to-1, row_to+2])
-        if self.boardGet(col_to+1, row_to+2) == piece: # Up 2 right 1
-            results.append([piece, col_to+1, row_to+2])
-        if self.boardGet(col_to-1, row_to-2) == piece: # Down 2 left 1
-            results.append([piece, col_to-1, row_to-2])
-        if self.boardGet(col_to+1, row_to-2) == piece: # Down 2 right 1
-            results.append([piece, col_to+1, row_to-2])
-        if self.boardGet(col_to+2, row_to+1) == piece: # Right 2 up 1
-            results.append([piece, col_to+2, row_to+1])
-        if self.boardGet(col_to+2, row_to-1) == piece: # Right 2 down 1
-            results.append([piece, col_to+2, row_to-1])
-        if self.boardGet(col_to-2, row_to+1) == piece: # Left 2 up 1
-            results.append([piece, col_to-2, row_to+1])
-        if self.boardGet(col_to-2, row_to-1) == piece: # Left 2 down 1
-            results.append([piece, col_to-2, row_to-1])
+        for sq in targets[to]:
+            if board[sq] == code:
+                results.append(sq)
         
         return results
     
-    def findMoveDiagonal(self, piece, col_to, row_to):
+    def findMoveSlide(self, piece, col_to, row_to, rays):
         """
-        Returns a list of diagonal moves to position(col_to, row_to)
+        Returns a list of the squares sliding pieces (bishops, rooks or queens) can move to position(col_to, row_to)
+        from
         
         Keyword arguments:
-        piece  -- the type of piece: "B" or "Q" for white, "b" or "q" for black
+        piece  -- the type of piece, upper case for white and lower case for black
         col_to -- the column the piece is moving to
         row_to -- the row the piece is moving to
+        rays   -- the table of rays to walk from the end position, DIAGONAL_RAYS or STRAIGHT_RAYS
         """
         
-        if self.boardGet(col_to, row_to) != "-":
-            if piece == "B" or piece == "Q":
-                # If a white piece is already at the end position, nothing can move there
-                if "PBNRQK".find(self.boardGet(col_to, row_to)) >= 0:
-                    return []
-            elif piece == "b" or piece == "q":
-                # If a black piece is already at the end position, nothing can move there
-                if "pbnrqk".find(self.boardGet(col_to, row_to)) >= 0:
-                    return []
-        
-        results = []
-        
-        # Up and right
-        for a in range(1, 8):
-            if self.boardGet(col_to+a, row_to+a) != "-":
-                if self.boardGet(col_to+a, row_to+a) == piece:
-                    results.append([piece, col_to+a, row_to+a])
-                break
+        code = PIECE_CODES[piece]
+        board = self.board
+        to = (row_to << 4) + col_to
+        target = board[to]
         
-        # Up and left
-        for a in range(1, 8):
-            if self.boardGet(col_to-a, row_to+a) != "-":
-                if self.boardGet(col_to-a, row_to+a) == piece:
-                    results.append([piece, col_to-a, row_to+a])
-                break
+        # If one of our own pieces is already at the end position, nothing can move there
+        if target != EMPTY and target & BLACK == code & BLACK:
+            return []
         
-        # Down and right
-        for a in range(1, 8):
-            if self.boardGet(col_to+a, row_to-a) != "-":
-                if self.boardGet(col_to+a, row_to-a) == piece:
-                    results.append([piece, col_to+a, row_to-a])
-                break
+        results = []
         
-        # Down and left
-        for a in range(1, 8):
-            if self.boardGet(col_to-a, row_to-a) != "-":
-                if self.boardGet(col_to-a, row_to-a) == piece:
-                    results.append([piece, col_to-a, row_to-a])
-                break
+        # Walk each ray until we hit a piece
+        for ray in rays[to]:
+            for sq in ray:
+                if board[sq] != EMPTY:
+                    if board[sq] == code:
+                        results.append(sq)
+                    break
         
         return results
     
-    def findMoveStraight(self, piece, col_to, row_to):
+    def findMoveN(self, piece, col_to, row_to):
         """
-        Returns a list of straight moves to position(col_to, row_to)
+        Returns a list of the squares knight moves to position(col_to, row_to) start from
         
         Keyword arguments:
-        piece  -- the type of piece: "R" or "Q" for white, "r" or "q" for black
+        piece  -- the type of piece: "N" for white, "n" for black
         col_to -- the column the piece is moving to
         row_to -- the row the piece is moving to
         """
         
-        if self.boardGet(col_to, row_to) != "-":
-            if piece == "R" or piece == "Q":
-                # If a white piece is already at the end position, nothing can move there
-                if "PBNRQK".find(self.boardGet(col_to, row_to)) >= 0:
-                    return []
-            elif piece == "r" or piece == "q":
-                # If a black piece is already at the end position, nothing can move there
-                if "pbnrqk".find(self.boardGet(col_to, row_to)) >= 0:
-                    return []
-        
-        results = []
-        
-        # Right
-        for a in range(1, 8):
-            if self.boardGet(col_to+a, row_to) != "-":
-                if self.boardGet(col_to+a, row_to) == piece:
-                    results.append([piece, col_to+a, row_to])
-                break
+        return self.findMoveStep(piece, col_to, row_to, KNIGHT_TARGETS)
+    
+    def findMoveDiagonal(self, piece, col_to, row_to):
+        """
+        Returns a list of the squares diagonal moves to position(col_to, row_to) start from
         
-        # Left
-        for a in range(1, 8):
-            if self.boardGet(col_to-a, row_to) != "-":
-                if self.boardGet(col_to-a, row_to) == piece:
-                    results.append([piece, col_to-a, row_to])
-                break
+        Keyword arguments:
+        piece  -- the type of piece: "B" or "Q" for white, "b" or "q" for black
+        col_to -- the column the piece is moving to
+        row_to -- the row the piece is moving to
+        """
         
-        # Up
-        for a in range(1, 8):
-            if self.boardGet(col_to, row_to+a) != "-":
-                if self.boardGet(col_to, row_to+a) == piece:
-                    results.append([piece, col_to, row_to+a])
-                break
+        return self.findMoveSlide(piece, col_to, row_to, DIAGONAL_RAYS)
+    
+    def findMoveStraight(self, piece, col_to, row_to):
+        """
+        Returns a list of the squares straight moves to position(col_to, row_to) start from
         
-        # Down
-        for a in range(1, 8):
-            if self.boardGet(col_to, row_to-a) != "-":
-                if self.boardGet(col_to, row_to-a) == piece:
-                    results.append([piece, col_to, row_to-a])
-                break
+        Keyword arguments:
+        piece  -- the type of piece: "R" or "Q" for white, "r" or "q" for black
+        col_to -- the column the piece is moving to
+        row_to -- the row the piece is moving to
+        """
         
-        return results
+        return self.findMoveSlide(piece, col_to, row_to, STRAIGHT_RAYS)
     
     def findMoveKing(self, piece, col_to, row_to):
         """
-        Returns a list of king moves to position(col_to, row_to)
+        Returns a list of the squares king moves to position(col_to, row_to) start from
         
         Keyword arguments:
         piece  -- the type of piece: "K" for white, "k" for black
@@ -497,36 +796,71 @@ class ChessGame(object):
         row_to -- the row the piece is moving to
         """
         
-        if self.boardGet(col_to, row_to) != "-":
-            if piece == "K":
-                # If a white piece is already at the end position, nothing can move there
-                if "PBNRQK".find(self.boardGet(col_to, row_to)) >= 0:
-                    return []
-            elif piece == "k":
-                # If a black piece is already at the end position, nothing can move there
-                if "pbnrqk".find(self.boardGet(col_to, row_to)) >= 0:
-                    return []
+        return self.findMoveStep(piece, col_to, row_to, KING_TARGETS)
+    
+    def findMoves(self, piece, col_to, row_to):
+        """
+        Returns a list of the squares pieces of one type can move to position(col_to, row_to) from, in the order
+        ambiguous moves are resolved in
+        
+        Keyword arguments:
+        piece  -- the type of piece, upper case for white and lower case for black
+        col_to -- the column the piece is moving to
+        row_to -- the row the piece is moving to
+        """
+        
+        kind = piece.upper()
+        if kind == "P":
+            if piece == "P":
+                return self.findMoveWP(col_to, row_to)
+            return self.findMoveBP(col_to, row_to)
+        elif kind == "N":
+            return self.findMoveN(piece, col_to, row_to)
+        elif kind == "B":
+            return self.findMoveDiagonal(piece, col_to, row_to)
+        elif kind == "R":
+            return self.findMoveStraight(piece, col_to, row_to)
+        elif kind == "Q":
+            return self.findMoveDiagonal(piece, col_to, row_to) + self.findMoveStraight(piece, col_to, row_to)
+        elif kind == "K":
+            return self.findMoveKing(piece, col_to, row_to)
+        return []
+    
+    def isAttacked(self, sq, colour):
+        """
+        Returns True or False depending on if a piece of one colour is attacking the square given, whatever is
+        standing on it
+        
+        Keyword arguments:
+        sq     -- the 0x88 square being checked
+        colour -- the colour of the attackers: 0 for white, BLACK for black
+        """
         
-        results = []
+        board = self.board
         
-        if self.boardGet(col_to, row_to+1) == piece: # Up 1
-            results.append([piece, col_to, row_to+1])
-        if self.boardGet(col_to, row_to-1) == piece: # Down 1
-            results.append([piece, col_to, row_to-1])
-        if self.boardGet(col_to+1, row_to) == piece: # Right 1
-            results.append([piece, col_to+1, row_to])
-        if self.boardGet(col_to-1, row_to) == piece: # Left 1
-            results.append([piece, col_to-1, row_to])
-        if self.boardGet(col_to+1, row_to+1) == piece: # Up 1 right 1
-            results.append([piece, col_to+1, row_to+1])
-        if self.boardGet(col_to-1, row_to+1) == piece: # Up 1 left 1
-            results.append([piece, col_to-1, row_to+1])
-        if self.boardGet(col_to+1, row_to-1) == piece: # Down 1 right 1
-            results.append([piece, col_to+1, row_to-1])
-        if self.boardGet(col_to-1, row_to-1) == piece: # Down 1 left 1
-            results.append([piece, col_to-1, row_to-1])
+        for fr in PAWN_ATTACKERS[colour >> 3][sq]:
+            if board[fr] == colour|PAWN:
+                return True
         
-        return results
+        for fr in KNIGHT_TARGETS[sq]:
+            if board[fr] == colour|KNIGHT:
+                return True
+        
+        for fr in KING_TARGETS[sq]:
+            if board[fr] == colour|KING:
+                return True
+        
+        # Walk each ray until we hit a piece
+        for rays, slider in ((DIAGONAL_RAYS, colour|BISHOP), (STRAIGHT_RAYS, colour|ROOK)):
+            for ray in rays[sq]:
+                for fr in ray:
+                    piece = board[fr]
+                    if piece != EMPTY:
+                        if piece == slider or piece == colour|QUEEN:
+                            return True
+                        break
+        
+        return False
     
     def isWhiteAttacking(self, col, row):
         """
@@ -537,24 +871,7 @@ class ChessGame(object):
         row -- the row of the position being checked
         """
         
-        if self.boardGet(col-1, row-1) == "P":
-            return True
-        elif self.boardGet(col+1, row-1) == "P":
-            return True
-        elif self.findMoveN("N", col, row) != []:
-            return True;
-        elif self.findMoveDiagonal("B", col, row) != []:
-            return True;
-        elif self.findMoveStraight("R", col, row) != []:
-            return True;
-        elif self.findMoveDiagonal("Q", col, row) != []:
-            return True;
-        elif self.findMoveStraight("Q", col, row) != []:
-            return True;
-        elif self.findMoveKing("K", col, row) != []:
-            return True;
-        else:
-            return False
+        return self.isAttacked((row << 4) + col, 0)
     
     def isBlackAttacking(self, col, row):
         """
@@ -565,24 +882,144 @@ class ChessGame(object):
         row -- the row of the position being checked
         """
         
-        if self.boardGet(col-1, row+1) == "p":
-            return True
-        elif self.boardGet(col+1, row+1) == "p":
+        return self.isAttacked((row << 4) + col, BLACK)
+    
+    def checkInfo(self):
+        """
+        Returns (checkers, pins, evasions) for the side to move: the squares of the pieces giving check, a dict of
+        pinned square ---> the step from the king it can still move along, and the squares anything but the king
+        can move to to get out of check. Worked out once per position
+        
+        Keyword arguments:
+        """
+        
+        if self.checks is not None and self.checks[0] == self.zobrist:
+            return self.checks[1:]
+        
+        board = self.board
+        colour = BLACK if self.turn == "b" else 0
+        enemy = colour ^ BLACK
+        king = self.kings[colour >> 3]
+        checkers = []
+        pins = {}
+        evasions = set()
+        
+        if king >= 0:
+            # Pawns and knights can only be captured, not blocked
+            for sq in PAWN_ATTACKERS[enemy >> 3][king]:
+                if board[sq] == enemy|PAWN:
+                    checkers.append(sq)
+                    evasions.add(sq)
+            
+            for sq in KNIGHT_TARGETS[king]:
+                if board[sq] == enemy|KNIGHT:
+                    checkers.append(sq)
+                    evasions.add(sq)
+            
+            # Walk each ray out from the king. An enemy slider is giving check if nothing is in the way, and pinning
+            # our piece if that is the only thing in the way
+            for rays, slider in ((DIAGONAL_RAYS, enemy|BISHOP), (STRAIGHT_RAYS, enemy|ROOK)):
+                for ray in rays[king]:
+                    pinned = -1
+                    for n, sq in enumerate(ray):
+                        piece = board[sq]
+                        if piece == EMPTY:
+                            continue
+                        if piece & BLACK == colour:
+                            if pinned >= 0:
+                                break
+                            pinned = sq
+                            continue
+                        if piece == slider or piece == enemy|QUEEN:
+                            if pinned >= 0:
+                                pins[pinned] = ray[0] - king
+                            else:
+                                checkers.append(sq)
+                                # Every square up to and including the checker blocks or captures it
+                                evasions.update(ray[:n+1])
+                        break
+        
+        self.checks = (self.zobrist, checkers, pins, evasions)
+        return self.checks[1:]
+    
+    def moveLegal(self, fr, to):
+        """
+        Returns True or False depending on if moving the piece on fr to to keeps the mover's king out of check. The
+        piece has to be able to make the move; castling is checked by castlingAllowed() instead
+        
+        Keyword arguments:
+        fr -- the 0x88 square the piece is moving from
+        to -- the 0x88 square the piece is moving to
+        """
+        
+        board = self.board
+        checkers, pins, evasions = self.checkInfo()
+        colour = board[fr] & BLACK
+        king = self.kings[colour >> 3]
+        
+        if fr == king:
+            if self.isAttacked(to, colour ^ BLACK) == True:
+                return False
+            # The king can't step back along the line of a slider checking it, that square is only safe while the
+            # king itself is in the way
+            for sq in checkers:
+                if board[sq] & 7 in (BISHOP, ROOK, QUEEN) and to == king + RAY_STEPS[king - sq + 119]:
+                    return False
             return True
-        elif self.findMoveN("n", col, row) != []:
-            return True;
-        elif self.findMoveDiagonal("b", col, row) != []:
-            return True;
-        elif self.findMoveStraight("r", col, row) != []:
-            return True;
-        elif self.findMoveDiagonal("q", col, row) != []:
-            return True;
-        elif self.findMoveStraight("q", col, row) != []:
-            return True;
-        elif self.findMoveKing("k", col, row) != []:
-            return True;
-        else:
+        
+        # Only the king can get out of double check
+        if len(checkers) > 1:
+            return False
+        
+        # A pinned piece can only move along the line between the king and the piece pinning it
+        if fr in pins and RAY_STEPS[to - king + 119] != pins[fr]:
+            return False
+        
+        # ep, a pawn moving diagonally onto an empty square
+        if board[fr] & 7 == PAWN and board[to] == EMPTY and (to - fr) & 7:
+            captured = (fr & 0x70) | (to & 7)
+            if checkers != [] and captured not in evasions and to not in evasions:
+                return False
+            return self.epExposesKing(king, fr, to, captured) == False
+        
+        if checkers != [] and to not in evasions:
             return False
+        
+        return True
+    
+    def epExposesKing(self, king, fr, to, captured):
+        """
+        Returns True or False depending on if taking ep opens a line to the king. Both pawns leave the line, so
+        the usual pins don't catch a rook behind them on the same row
+        
+        Keyword arguments:
+        king     -- the 0x88 square of the capturing side's king
+        fr       -- the 0x88 square the capturing pawn is moving from
+        to       -- the 0x88 square the capturing pawn is moving to
+        captured -- the 0x88 square of the pawn being taken
+        """
+        
+        board = self.board
+        colour = board[fr] & BLACK
+        enemy = colour ^ BLACK
+        
+        for square in set((fr, captured)):
+            offset = RAY_STEPS[square - king + 119]
+            if offset == 0:
+                continue
+            slider = enemy | (BISHOP if offset in DIAGONAL_OFFSETS else ROOK)
+            sq = king + offset
+            while not sq & 0x88:
+                if sq == to:
+                    break
+                piece = board[sq]
+                if piece != EMPTY and sq != fr and sq != captured:
+                    if piece == slider or piece == enemy|QUEEN:
+                        return True
+                    break
+                sq += offset
+        
+        return False
     
     def colRowToStr(self, col, row):
         return chr(col + 97) + chr(row + 49)
@@ -598,12 +1035,8 @@ class ChessGame(object):
         if len(str) != 2:
             return False
         
-        col = self.posGetCol(str)
-        if col < 0 or col > 7:
-            return False
-        
-        row = self.posGetRow(str)
-        if row < 0 or row > 7:
+        # Checked as characters first, as anything but a digit would make posGetRow() raise
+        if "abcdefgh".find(str[0]) < 0 or "12345678".find(str[1]) < 0:
             return False
         
         return True
@@ -620,8 +1053,15 @@ class ChessGame(object):
         promotion -- the piece we're promoting to, default is to not promote: "-"
         """
         
+        board = self.board
+        fr = (from_row << 4) + from_col
+        to = (to_row << 4) + to_col
+        piece = board[fr]
+        castling = self.castling
+        ep = self.ep
+        
         # 50 move rule
-        if self.boardGet(to_col, to_row) != "-" or self.boardGet(from_col, from_row) == "P" or self.boardGet(from_col, from_row) == "p":
+        if board[to] != EMPTY or piece & 7 == PAWN:
             self.fiftyMoves = 0
         else:
             self.fiftyMoves += 1
@@ -646,30 +1086,36 @@ class ChessGame(object):
         if self.castling == "":
             self.castling = "-"
         
+        if self.castling != castling:
+            self.zobrist ^= self.castlingHash(castling) ^ self.castlingHash(self.castling)
+        
         # Capture ep white
-        if self.ep != "-" and self.boardGet(from_col, from_row) == "P":
+        if self.ep != "-" and piece == PAWN:
             if self.posGetCol(self.ep) == to_col and self.posGetRow(self.ep) == to_row:
-                self.boardSet(self.posGetCol(self.ep), self.posGetRow(self.ep)-1, "-")
+                self.squareSet(to-16, EMPTY)
         # Capture ep black
-        if self.ep != "-" and self.boardGet(from_col, from_row) == "p":
+        if self.ep != "-" and piece == BLACK|PAWN:
             if self.posGetCol(self.ep) == to_col and self.posGetRow(self.ep) == to_row:
-                self.boardSet(self.posGetCol(self.ep), self.posGetRow(self.ep)+1, "-")
+                self.squareSet(to+16, EMPTY)
         
-        # Play the move
+        # Play the move, promoting to a piece of the mover's colour
         if promotion == "-":
-            self.boardSet(to_col, to_row, self.boardGet(from_col, from_row))
+            self.squareSet(to, piece)
         else:
-            self.boardSet(to_col, to_row, promotion)
-        self.boardSet(from_col, from_row, "-")
+            self.squareSet(to, PIECE_CODES[promotion.upper()] | piece & BLACK)
+        self.squareSet(fr, EMPTY)
         
         # Set the ep square
-        if self.boardGet(to_col, to_row) == "P" and to_row - from_row == 2:
+        if board[to] == PAWN and to_row - from_row == 2:
             self.ep = self.colRowToStr(to_col, to_row-1)
-        elif self.boardGet(to_col, to_row) == "p" and to_row - from_row == -2:
+        elif board[to] == BLACK|PAWN and to_row - from_row == -2:
             self.ep = self.colRowToStr(to_col, to_row+1)
         else:
             self.ep = "-"
         
+        if self.ep != ep:
+            self.zobrist ^= self.epHash(ep) ^ self.epHash(self.ep)
+        
         return True
     
     def moveMakeWKSC(self):
@@ -692,88 +1138,96 @@ class ChessGame(object):
         self.moveMake(0,7, 3,7) # Rook
         self.fiftyMoves -= 1
     
-    def moveParse(self, move):
+    def castlingAllowed(self, side):
         """
-        Returns True or False depending on if the algebraic notation move provided can be parsed and found in the list of available moves
+        Returns True or False depending on if the side to move is allowed to castle
         
         Keyword arguments:
-        move -- the move provided
+        side -- "K" to castle kingside, "Q" to castle queenside
         """
         
-        if len(move) < 2:
+        if self.turn == "w":
+            right = side
+            row = 0
+            isAttacking = self.isBlackAttacking
+        elif self.turn == "b":
+            right = side.lower()
+            row = 7
+            isAttacking = self.isWhiteAttacking
+        else:
             return False
-    
-        # Remove irrelevant characters
-        strip = "!?+#x-:="
-        for a in strip:
-            move = move.replace(a, "")
         
-        # Special case of castling
-        if move == "OO" or move == "00":
-            if self.turn == "w":
-                # Check castling permissions
-                if self.castling.find("K") < 0:
-                    return False
-                # Check squares not empty or attacked
-                if self.isBlackAttacking(4, 0) == True: # e1
-                    return False
-                if self.isBlackAttacking(5, 0) == True or self.boardGet(5, 0) != "-": # f1
-                    return False
-                if self.isBlackAttacking(6, 0) == True or self.boardGet(6, 0) != "-": # g1
-                    return False
-                self.moveMakeWKSC()
-                return True
-            elif self.turn == "b":
-                # Check squares not empty or attacked
-                if self.isWhiteAttacking(4, 7) == True: # e8
-                    return False
-                if self.isWhiteAttacking(5, 7) == True or self.boardGet(5, 7) != "-": # f8
+        # Check castling permissions
+        if self.castling.find(right) < 0:
+            return False
+        
+        # Check the king isn't in check
+        if isAttacking(4, row) == True:
+            return False
+        
+        # Check the king and rook are still there, and the squares between them are empty and the king
+        # doesn't pass through or land on an attacked square
+        if side == "K":
+            if self.boardGet(7, row).upper() != "R":
+                return False
+            for col in (5, 6):
+                if isAttacking(col, row) == True or self.boardGet(col, row) != "-":
                     return False
-                if self.isWhiteAttacking(6, 7) == True or self.boardGet(6, 7) != "-": # g8
+        else:
+            if self.boardGet(0, row).upper() != "R":
+                return False
+            for col in (3, 2):
+                if isAttacking(col, row) == True or self.boardGet(col, row) != "-":
                     return False
-                self.moveMakeBKSC()
-                return True
+            if self.boardGet(1, row) != "-":
+                return False
+        
+        return True
+    
+    def moveParse(self, move):
+        """
+        Returns True or False depending on if the algebraic notation move provided can be parsed and found in the list of available moves
+        
+        Keyword arguments:
+        move -- the move provided
+        """
+        
+        packed = self.moveFind(move)
+        if packed is None:
+            return False
+        
+        return self.moveApply(packed)
+    
+    def moveFind(self, move):
+        """
+        Returns the legal move the algebraic notation move provided stands for, packed by packMove(), or None if it
+        can't be parsed or isn't legal. The position is left as it is
+        
+        Keyword arguments:
+        move -- the move provided
+        """
+        
+        move = self.moveClean(move)
+        if len(move) < 2:
+            return None
+        
+        # Special case of castling, which is the king moving two squares
+        king = self.kings[0 if self.turn == "w" else 1]
+        if move == "OO" or move == "00":
+            if self.castlingAllowed("K") == False:
+                return None
+            return packMove(king, king+2)
         elif move == "OOO" or move == "000":
-            if self.turn == "w":
-                # Check castling permissions
-                if self.castling.find("Q") < 0:
-                    return False
-                # Check castling permissions
-                if self.castling.find("k") < 0:
-                    return False
-                # Check squares not empty or attacked
-                if self.isBlackAttacking(4, 0) == True: # e1
-                    return False
-                if self.isBlackAttacking(3, 0) == True or self.boardGet(3, 0) != "-": # d1
-                    return False
-                if self.isBlackAttacking(2, 0) == True or self.boardGet(2, 0) != "-": # c1
-                    return False
-                if self.boardGet(1, 0) != "-": # b1
-                    return False
-                self.moveMakeWQSC()
-                return True
-            elif self.turn == "b":
-                # Check castling permissions
-                if self.castling.find("q") < 0:
-                    return False
-                # Check squares not empty or attacked
-                if self.isWhiteAttacking(4, 7) == True: # e8
-                    return False
-                if self.isWhiteAttacking(3, 7) == True or self.boardGet(3, 7) != "-": # d8
-                    return False
-                if self.isWhiteAttacking(2, 7) == True or self.boardGet(2, 7) != "-": # c8
-                    return False
-                if self.boardGet(1, 7) != "-": # b8
-                    return False
-                self.moveMakeBQSC()
-                return True
+            if self.castlingAllowed("Q") == False:
+                return None
+            return packMove(king, king-2)
         
         # If we're supplied with a piece type - Store and remove it e.g. (Nf3 ---> f3)
         piece_type = "P"
         if move[0].isupper():
             piece_type = move[0]
             if "BNRQK".find(piece_type) < 0:
-                return False
+                return None
             move = move[1:]
         
         # If the move is a promotion - store and remove it e.g. (a8Q ---> a8)
@@ -781,12 +1235,12 @@ class ChessGame(object):
         if move[-1:].isalpha():
             promotion = move[-1:]
             if "BNRQ".find(promotion) < 0:
-                return False
+                return None
             move = move[:-1]
         
         # Can't promote pieces other than pawns
         if promotion != "-" and piece_type != "P":
-            return False
+            return None
         
         # By this point we should be left with either 2, 3, or 4 characters
         
@@ -805,180 +1259,1791 @@ class ChessGame(object):
         # a7a8Q
         #
         
-        hint_col = -1
-        hint_row = -1
-        firstChunk = move[:2]
-        secondChunk = move[-2:]
+        hint_col = -1
+        hint_row = -1
+        firstChunk = move[:2]
+        secondChunk = move[-2:]
+        
+        if self.onBoard(secondChunk) == False:
+            return None;
+        
+        if len(move) == 4:
+            if self.onBoard(firstChunk) == False:
+                return None;
+            hint_col = self.posGetCol(firstChunk)
+            hint_row = self.posGetRow(firstChunk)
+            move = move[2:]
+            piece_type = self.boardGet(hint_col, hint_row)
+        elif len(move) == 3:
+            if firstChunk != secondChunk:
+                if "abcdefgh".find(firstChunk[0]) >= 0:
+                    hint_col = self.charToCol(firstChunk[0])
+                elif "12345678".find(firstChunk[0]) >= 0:
+                    hint_row = self.charToRow(firstChunk[0])
+                else:
+                    return None
+                move = move[1:]
+        elif len(move) == 2:
+            pass
+        else:
+            return None
+            
+        # Convert the move to col & row
+        col_to = self.posGetCol(move)
+        row_to = self.posGetRow(move)
+        
+        # Can't promote pieces other than pawns
+        if self.turn == "w":
+            if promotion != "-" and row_to != 7:
+                return None
+        elif self.turn == "b":
+            if promotion != "-" and row_to != 0:
+                return None
+        
+        # Find the squares pieces of the type given can move there from
+        piece_type = piece_type.upper()
+        if self.turn == "w":
+            candidates = self.findMoves(piece_type, col_to, row_to)
+        elif self.turn == "b":
+            candidates = self.findMoves(piece_type.lower(), col_to, row_to)
+        else:
+            return None
+        
+        # Compare the candidates to the hint (if any)
+        to = (row_to << 4) + col_to
+        for fr in candidates:
+            if hint_col != -1 and fr & 7 != hint_col:
+                continue;
+            if hint_row != -1 and fr >> 4 != hint_row:
+                continue;
+            
+            # Leave out pieces that can't legally make the move, such as a pinned one
+            if self.moveLegal(fr, to) == False:
+                continue
+            
+            # A pawn reaching the last row without saying what it promotes to becomes a queen
+            if piece_type == "P" and (row_to == 0 or row_to == 7):
+                if promotion == "-":
+                    promotion = "Q"
+                return packMove(fr, to, PIECE_CODES[promotion] | self.board[fr] & BLACK)
+            
+            return packMove(fr, to)
+        
+        # Didn't find any matches
+        return None
+    
+    def moveClean(self, move):
+        """
+        Returns the move given with the characters that don't change its meaning removed (Nxf3+ ---> Nf3)
+        
+        Keyword arguments:
+        move -- the move provided
+        """
+        
+        # Remove irrelevant characters
+        strip = "!?+#x-:="
+        for a in strip:
+            move = move.replace(a, "")
+        return move
+    
+    def moveSplit(self, moves):
+        """
+        Returns the list of moves in the string given, leaving out move numbers
+        
+        Keyword arguments:
+        moves -- the list of moves, separated by spaces
+        """
+        
+        split = []
+        
+        for a in moves.split(" "):
+            if a == '':
+                continue
+            # Castling written with zeros (0-0, 0-0-0) starts with a digit too, but isn't a move number
+            if a[0].isdigit() == True and self.moveClean(a) not in ("00", "000"):
+                continue
+            split.append(a)
+        
+        return split
+    
+    def moveParses(self, moves, san=None):
+        """
+        Parses the list of moves given and plays them
+        
+        Keyword arguments:
+        moves -- the list of moves to be played
+        san   -- a list to add each move played to in SAN, or None
+        """
+        
+        return self.playMoves(self.moveSplit(moves), san)
+    
+    def playMoves(self, moves, san=None):
+        """
+        Plays moves one at a time, such as the moves of a PGNGame. Returns True or False depending on if every move
+        was legal
+        
+        Keyword arguments:
+        moves -- an iterable of moves
+        san   -- a list to add each move played to in SAN, or None. If a move isn't legal it is the one after the
+                 last move added
+        """
+        
+        for a in moves:
+            if san is not None:
+                r = self.pushSAN(a)
+                if r is None:
+                    return False
+                san.append(r)
+            elif self.push(a) == False:
+                return False
+            self.findOpening()
+            
+        return True
+    
+    def snapshot(self):
+        """
+        Returns a compact copy of the current position that restore() can return to
+        
+        Keyword arguments:
+        """
+        
+        board = bytes(self.board)
+        board = "".join([board[sq:sq+8] for sq in ROW_STARTS])
+        return Position(board, self.turn, self.castling, self.ep, self.fiftyMoves, self.fullMoves, self.zobrist,
+                        self.opening)
+    
+    def restore(self, snapshot):
+        """
+        Sets the board to a position saved by snapshot(). The undo history is cleared
+        
+        Keyword arguments:
+        snapshot -- the position returned by snapshot()
+        """
+        
+        board = self.board
+        for a, sq in enumerate(ROW_STARTS):
+            board[sq:sq+8] = snapshot.board[a*8:a*8+8]
+        self.turn = snapshot.turn
+        self.castling = snapshot.castling
+        self.ep = snapshot.ep
+        self.fiftyMoves = snapshot.fiftyMoves
+        self.fullMoves = snapshot.fullMoves
+        self.zobrist = snapshot.zobrist
+        self.opening = snapshot.opening
+        self.indexPieces()
+        self.history = []
+    
+    def push(self, move):
+        """
+        Plays a single move and remembers how to take it back with pop(). Returns True or False depending on if the
+        move was legal; an illegal move leaves the position untouched
+        
+        Keyword arguments:
+        move -- the move provided, in algebraic notation or as a packed move from legalMoves()
+        """
+        
+        # Undo record: (squares changed, turn, castling, ep, fiftyMoves, fullMoves, zobrist, opening)
+        self.changes = []
+        undo = (self.changes, self.turn, self.castling, self.ep, self.fiftyMoves, self.fullMoves, self.zobrist,
+                self.opening)
+        
+        if isinstance(move, int):
+            r = self.movePlay(move)
+        else:
+            r = self.moveParse(move)
+        self.changes = None
+        
+        if r == False or self.turnEnd() == False:
+            self.undo(undo)
+            return False
+        
+        self.history.append(undo)
+        return True
+    
+    def pop(self):
+        """
+        Takes back the last move played with push(). Returns False if there is nothing to take back
+        
+        Keyword arguments:
+        """
+        
+        if self.history == []:
+            return False
+        
+        self.undo(self.history.pop())
+        return True
+    
+    def undo(self, undo):
+        """
+        Restores the position from before the move described by an undo record
+        
+        Keyword arguments:
+        undo -- the undo record made by push()
+        """
+        
+        changes, self.turn, self.castling, self.ep, self.fiftyMoves, self.fullMoves, zobrist, self.opening = undo
+        for sq, piece in reversed(changes):
+            self.squareSet(sq, piece)
+        self.zobrist = zobrist
+    
+    def turnEnd(self):
+        """
+        Passes the turn to the other side once a move has been played. Moves are checked for legality before
+        they're made, so this only returns False if a king was captured, which can only happen from a FEN where
+        the side not to move is in check
+        
+        Keyword arguments:
+        """
+        
+        # King positions are kept up to date by moveMake
+        if self.kings[0] < 0 or self.kings[1] < 0:
+            return False
+        
+        self.zobrist ^= ZOBRIST_BLACK
+        
+        if self.turn == "w":
+            self.turn = "b"
+        elif self.turn == "b":
+            self.turn = "w"
+            self.fullMoves += 1
+        
+        return True
+    
+    def movePlay(self, move):
+        """
+        Plays a move generated by pseudoMoves() on the board. Returns False if it would leave the mover's king in check
+        
+        Keyword arguments:
+        move -- the packed move, see packMove()
+        """
+        
+        fr = move >> 11
+        to = move >> 4 & 127
+        
+        # Castling is generated as the king moving two squares
+        if self.board[fr] & 7 == KING and (to - fr == 2 or to - fr == -2):
+            if self.castlingAllowed("K" if to > fr else "Q") == False:
+                return False
+        elif self.moveLegal(fr, to) == False:
+            return False
+        
+        return self.moveApply(move)
+    
+    def moveApply(self, move):
+        """
+        Plays a move on the board without checking it's legal, for moves that already have been
+        
+        Keyword arguments:
+        move -- the packed move, see packMove()
+        """
+        
+        fr = move >> 11
+        to = move >> 4 & 127
+        
+        if self.board[fr] & 7 == KING and (to - fr == 2 or to - fr == -2):
+            if to == 6:
+                self.moveMakeWKSC()
+            elif to == 2:
+                self.moveMakeWQSC()
+            elif to == 118:
+                self.moveMakeBKSC()
+            else:
+                self.moveMakeBQSC()
+            return True
+        
+        return self.moveMake(fr & 7, fr >> 4, to & 7, to >> 4, PIECE_CHARS[move & 15])
+    
+    def pseudoMoves(self):
+        """
+        Returns a list of every move the side to move can make, ignoring whether it leaves their own king in check.
+        Moves are packed into ints by packMove()
+        
+        Keyword arguments:
+        """
+        
+        board = self.board
+        moves = []
+        
+        if self.turn == "w":
+            colour = 0
+            forward = 16
+            start_row = 1
+            last_row = 7
+            promotions = (QUEEN, ROOK, BISHOP, KNIGHT)
+        elif self.turn == "b":
+            colour = BLACK
+            forward = -16
+            start_row = 6
+            last_row = 0
+            promotions = (BLACK|QUEEN, BLACK|ROOK, BLACK|BISHOP, BLACK|KNIGHT)
+        else:
+            return moves
+        
+        ep = -1
+        if self.ep != "-":
+            ep = (self.posGetRow(self.ep) << 4) + self.posGetCol(self.ep)
+        
+        # Moves are packed inline rather than by calling packMove(), this is the hottest loop in perft
+        for fr in self.pieceLists[colour >> 3]:
+            packed = fr << 11
+            kind = board[fr] & 7
+            
+            if kind == PAWN:
+                targets = []
+                
+                # Pushes
+                to = fr + forward
+                if board[to] == EMPTY:
+                    targets.append(to)
+                    if fr >> 4 == start_row and board[to+forward] == EMPTY:
+                        targets.append(to+forward)
+                
+                # Captures, including ep
+                for to in (fr+forward-1, fr+forward+1):
+                    if to & 0x88:
+                        continue
+                    if to == ep or (board[to] != EMPTY and board[to] & BLACK != colour):
+                        targets.append(to)
+                
+                for to in targets:
+                    if to >> 4 == last_row:
+                        for promotion in promotions:
+                            moves.append(packed | to << 4 | promotion)
+                    else:
+                        moves.append(packed | to << 4)
+            
+            elif kind == KNIGHT or kind == KING:
+                for to in (KNIGHT_TARGETS[fr] if kind == KNIGHT else KING_TARGETS[fr]):
+                    if board[to] == EMPTY or board[to] & BLACK != colour:
+                        moves.append(packed | to << 4)
+            
+            else:
+                if kind == BISHOP:
+                    rays = DIAGONAL_RAYS[fr]
+                elif kind == ROOK:
+                    rays = STRAIGHT_RAYS[fr]
+                else:
+                    rays = DIAGONAL_RAYS[fr] + STRAIGHT_RAYS[fr]
+                
+                # Walk each ray until we hit a piece
+                for ray in rays:
+                    for to in ray:
+                        if board[to] != EMPTY:
+                            if board[to] & BLACK != colour:
+                                moves.append(packed | to << 4)
+                            break
+                        moves.append(packed | to << 4)
+        
+        # Castling
+        king = self.kings[colour >> 3]
+        if self.castlingAllowed("K") == True:
+            moves.append(packMove(king, king+2))
+        if self.castlingAllowed("Q") == True:
+            moves.append(packMove(king, king-2))
+        
+        return moves
+    
+    def legalMoves(self):
+        """
+        Returns a list of every legal move in the current position, as packed moves that can be given to push()
+        
+        Keyword arguments:
+        """
+        
+        moves = []
+        
+        for move in self.pseudoMoves():
+            if self.push(move) == True:
+                self.pop()
+                moves.append(move)
+        
+        return moves
+    
+    def moveToStr(self, move):
+        """
+        Returns the move given in longhand notation, e.g. packMove(12, 28) ---> e2e4
+        
+        Keyword arguments:
+        move -- the packed move
+        """
+        
+        fr, to, promotion = unpackMove(move)
+        r = self.colRowToStr(fr & 7, fr >> 4) + self.colRowToStr(to & 7, to >> 4)
+        if promotion != EMPTY:
+            r += PIECE_CHARS[promotion & 7]
+        return r
+    
+    def moveToSAN(self, move):
+        """
+        Returns a legal move in the current position in SAN, e.g. packMove(6, 37) ---> Nf4 or Ngf4+
+        
+        Keyword arguments:
+        move -- the packed move
+        """
+        
+        san = self.sanMove(move)
+        self.push(move)
+        san += self.sanCheck()
+        self.pop()
+        return san
+    
+    def pushSAN(self, move):
+        """
+        Plays a single move like push(), returning it in SAN, or None if it isn't legal
+        
+        Keyword arguments:
+        move -- the move provided, in algebraic notation
+        """
+        
+        packed = self.moveFind(move)
+        if packed is None:
+            return None
+        
+        san = self.sanMove(packed)
+        if self.push(packed) == False:
+            return None
+        return san + self.sanCheck()
+    
+    def sanMove(self, move):
+        """
+        Returns a legal move in the current position in SAN, without the check or mate suffix
+        
+        Keyword arguments:
+        move -- the packed move
+        """
+        
+        fr, to, promotion = unpackMove(move)
+        board = self.board
+        piece = board[fr]
+        kind = piece & 7
+        square = self.colRowToStr(to & 7, to >> 4)
+        
+        if kind == KING and (to - fr == 2 or to - fr == -2):
+            return "O-O" if to > fr else "O-O-O"
+        
+        if kind == PAWN:
+            # Pawns that capture, including ep, are named by their column
+            if (to - fr) & 7:
+                san = chr((fr & 7) + 97) + "x" + square
+            else:
+                san = square
+            if promotion != EMPTY:
+                san += "=" + PIECE_CHARS[promotion & 7]
+            return san
+        
+        san = PIECE_CHARS[kind]
+        
+        # Say which piece is moving if another of the same type could legally make the move too: by column if
+        # that's enough, then by row, then by both
+        others = [sq for sq in self.findMoves(PIECE_CHARS[piece], to & 7, to >> 4)
+                  if sq != fr and self.moveLegal(sq, to) == True]
+        if others != []:
+            if all(sq & 7 != fr & 7 for sq in others):
+                san += chr((fr & 7) + 97)
+            elif all(sq >> 4 != fr >> 4 for sq in others):
+                san += chr((fr >> 4) + 49)
+            else:
+                san += self.colRowToStr(fr & 7, fr >> 4)
+        
+        if board[to] != EMPTY:
+            san += "x"
+        return san + square
+    
+    def sanCheck(self):
+        """
+        Returns the SAN suffix for the move just played: "+" for check, "#" for mate, or nothing
+        
+        Keyword arguments:
+        """
+        
+        checkers, pins, evasions = self.checkInfo()
+        if checkers == []:
+            return ""
+        return "+" if self.hasLegalMove() == True else "#"
+    
+    def hasLegalMove(self):
+        """
+        Returns True or False depending on if the side to move has any legal move
+        
+        Keyword arguments:
+        """
+        
+        # Castling is only generated when it's allowed, and moveLegal() agrees with castlingAllowed() about the
+        # king's own squares, so every move can be checked the same way
+        for move in self.pseudoMoves():
+            if self.moveLegal(move >> 11, move >> 4 & 127) == True:
+                return True
+        return False
+    
+    def moveJoin(self, san, fullMoves=1, turn="w"):
+        """
+        Returns a list of SAN moves with move numbers, e.g. ["e4", "e5", "Nf3"] ---> 1. e4 e5 2. Nf3
+        
+        Keyword arguments:
+        san       -- the moves, in SAN
+        fullMoves -- the number of the first move
+        turn      -- whose move the first one is, "w" or "b"
+        """
+        
+        parts = []
+        black = turn == "b"
+        for a, move in enumerate(san):
+            if not black:
+                parts.append("{}.".format(fullMoves))
+            elif a == 0:
+                parts.append("{}...".format(fullMoves))
+            parts.append(move)
+            if black:
+                fullMoves += 1
+            black = not black
+        return " ".join(parts)
+    
+    def perft(self, depth):
+        """
+        Returns the number of leaf positions reached by playing every legal move sequence of the given length
+        
+        Keyword arguments:
+        depth -- the number of plies to search
+        """
+        
+        if depth == 0:
+            return 1
+        
+        nodes = 0
+        for move in self.pseudoMoves():
+            if self.push(move) == True:
+                if depth == 1:
+                    nodes += 1
+                else:
+                    nodes += self.perft(depth-1)
+                self.pop()
+        
+        return nodes
+    
+    def test(self, fen, moves):
+        """
+        Compares the FEN provided with the FEN calculated from parsing and playing the moves given
+        
+        Keyword arguments:
+        fen   -- the expected board position in FEN notation
+        moves -- the list of moves to be played
+        """
+        
+        # Check the FEN provided is accurate before trying to test the moves against it
+        r = self.setFEN(fen)
+        if r == False:
+            print("Invalid FEN:   {}".format(fen))
+            return
+        
+        # Reset to startpos FEN
+        r = self.setFEN(ChessGame.fen_startpos)
+        if r == False:
+            print("Invalid start FEN: {}".format(ChessGame.fen_startpos))
+            return
+        
+        # Play the moves provided
+        r = self.moveParses(moves)
+        if r == False:
+            print("Invalid moves: {}".format(moves))
+            return
+        
+        # Get the FEN from the board now the moves have been played
+        r = self.getFEN()
+        if r == False:
+            print("Invalid FEN:   {}".format(fen))
+            return
+        
+        if self.fen == fen:
+            print("Passed: {}".format(moves))
+        else:
+            print("Failed: {}".format(moves))
+        
+        #print("Fen:   {}".format(fen))
+        #print("Moves: {}".format(moves))
+
+class LichessError(Exception):
+    """
+    Raised when the Lichess API answers with an unexpected HTTP status
+    """
+
+
+class CountingEndpoint(object):
+    """
+    Wraps a client endpoint to count the connections made through it. HTTPConnectionPool only connects the endpoint
+    it is given when it has no idle connection to reuse, so this counts new connections without reaching into it
+    """
+    
+    def __init__(self, endpoint, counter):
+        """
+        Keyword arguments:
+        endpoint -- the endpoint to connect with
+        counter  -- called each time a connection is made
+        """
+        
+        self.endpoint = endpoint
+        self.counter = counter
+    
+    def connect(self, protocolFactory):
+        """
+        Counts the connection and makes it with the wrapped endpoint
+        
+        Keyword arguments:
+        protocolFactory -- the factory for the connection's protocol
+        """
+        
+        self.counter()
+        return self.endpoint.connect(protocolFactory)
+
+
+class LichessConnectionPool(HTTPConnectionPool):
+    """
+    A pool of persistent HTTP connections that limits how many requests are in flight at once and counts how many
+    were sent over a reused connection
+    """
+    
+    def __init__(self, reactor, maxPerHost, idleTimeout):
+        """
+        Keyword arguments:
+        reactor     -- the reactor to make connections with
+        maxPerHost  -- the most connections to have open to each host at once, busy or idle
+        idleTimeout -- seconds an idle connection is kept open before it is closed
+        """
+        
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = maxPerHost
+        self.cachedConnectionTimeout = idleTimeout
+        # Every request goes to the Lichess API, so one semaphore is the per host limit. A request holds its slot
+        # until its response has been read, see run()
+        self.slots = defer.DeferredSemaphore(maxPerHost)
+        self.requests = 0
+        self.created = 0
+    
+    def run(self, request, *args):
+        """
+        Calls request once fewer than maxPerHost requests are in flight and returns a Deferred that fires with its
+        result. The slot is held until the Deferred request returns has fired, so request should include reading
+        the body. Cancelling the Deferred gives up the wait for a slot, or cancels the request if it has started
+        
+        Keyword arguments:
+        request -- makes the request with the pool's Agent and returns a Deferred
+        args    -- passed to request
+        """
+        
+        return self.slots.run(request, *args)
+    
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        return HTTPConnectionPool.getConnection(self, key, CountingEndpoint(endpoint, self.countConnection))
+    
+    def countConnection(self):
+        """
+        Counts a new connection, called by the CountingEndpoint getConnection() hands the pool
+        
+        Keyword arguments:
+        """
+        
+        self.created += 1
+    
+    def stats(self):
+        """
+        Returns the pool counters as a dict
+        
+        Keyword arguments:
+        """
+        
+        return {
+            "requests_total": self.requests,
+            "requests_in_flight": self.slots.limit - self.slots.tokens,
+            "requests_waiting": len(self.slots.waiting),
+            "connections_created_total": self.created,
+            "connections_reused_total": self.requests - self.created,
+        }
+
+
+class TeamPageReader(protocol.Protocol):
+    """
+    Reads one page of a Lichess team roster as it arrives, decoding each member as soon as it is complete instead of
+    buffering the whole body. Fires finished with the number of members read and the number of pages Lichess says
+    there are, or None if it doesn't say
+    """
+    
+    listStart = re.compile(r'"(?:list|currentPageResults)"\s*:\s*\[')
+    # Only counted once the number has ended, so one split across chunks isn't read short
+    pageCount = re.compile(r'"(?:nbPages|lastPage)"\s*:\s*(\d+)\s*[,}]')
+    decoder = json.JSONDecoder()
+    
+    def __init__(self, finished, onMember):
+        """
+        Keyword arguments:
+        finished -- the Deferred to fire once the body has been read
+        onMember -- called with each member dict as it is decoded
+        """
+        
+        self.finished = finished
+        self.onMember = onMember
+        self.buffer = ""
+        # None until the member list starts, True inside it, False once it has ended
+        self.inList = None
+        self.count = 0
+        self.lastPage = None
+    
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        
+        self.buffer += data
+        if self.inList is None:
+            match = self.listStart.search(self.buffer)
+            if match is None:
+                return
+            self.findLastPage(self.buffer[:match.start()])
+            self.buffer = self.buffer[match.end():]
+            self.inList = True
+        
+        if self.inList is True:
+            try:
+                self.readMembers()
+            except Exception:
+                self.transport.stopProducing()
+                self.finished.errback()
+                return
+        
+        if self.inList is False:
+            # The page count can come after the list, so keep just enough of the rest to find it
+            self.findLastPage(self.buffer)
+            self.buffer = self.buffer[-32:]
+    
+    def findLastPage(self, text):
+        """
+        Remembers the number of pages if the text given says it
+        
+        Keyword arguments:
+        text -- part of the body outside the member list
+        """
+        
+        if self.lastPage is None:
+            match = self.pageCount.search(text)
+            if match is not None:
+                self.lastPage = int(match.group(1))
+    
+    def readMembers(self):
+        """
+        Decodes every complete member at the front of the buffer, leaving any partial one for the next chunk
+        
+        Keyword arguments:
+        """
+        
+        buf = self.buffer
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buf):
+                break
+            if buf[pos] == "]":
+                self.inList = False
+                pos += 1
+                break
+            try:
+                member, pos = self.decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Not all of this member has arrived yet
+                break
+            self.count += 1
+            self.onMember(member)
+        self.buffer = buf[pos:]
+    
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.errback(reason)
+        elif self.inList is not False:
+            self.finished.errback(LichessError("Team roster was cut short or not understood"))
+        else:
+            self.findLastPage(self.buffer)
+            self.finished.callback((self.count, self.lastPage))
+
+
+class TeamRosterFetch(object):
+    """
+    Pages through a whole team roster with a few requests in flight at once, keeping only the online members
+    """
+    
+    def __init__(self, getPage, pageSize, parallel, maxPages):
+        """
+        Keyword arguments:
+        getPage  -- called with (page, onMember) to read a page, returns a Deferred firing with the number of members
+                    on it and the number of pages (or None if not known), or with None if there is no such page
+        pageSize -- the members asked for per page, a shorter page is the last one
+        parallel -- the most pages to request at once
+        maxPages -- the most pages to request in total
+        """
+        
+        self.getPage = getPage
+        self.pageSize = pageSize
+        self.parallel = parallel
+        self.maxPages = maxPages
+        self.nextPage = 1
+        self.lastPage = None
+        self.found = True
+        # page ---> usernames of the online members on it
+        self.online = {}
+        self.seen = set()
+    
+    def start(self):
+        """
+        Returns a Deferred that fires with the list of online usernames in roster order, or None if the team doesn't
+        exist
+        
+        Keyword arguments:
+        """
+        
+        # The first page says how many pages there are, so the rest are only asked for once that's known and no
+        # request is made past the end
+        d = self.fetch()
+        d.addCallback(lambda more: defer.gatherResults([self.work() for i in range(self.parallel)],
+                                                       consumeErrors=True))
+        d.addCallbacks(self.result, self.failed)
+        return d
+    
+    def work(self):
+        d = self.fetch()
+        d.addCallback(lambda more: self.work() if more else None)
+        return d
+    
+    def fetch(self):
+        """
+        Requests the next page. Returns a Deferred that fires with True once it has been read, or False if there are
+        no pages left to request
+        
+        Keyword arguments:
+        """
+        
+        page = self.nextPage
+        if page > self.maxPages or (self.lastPage is not None and page > self.lastPage):
+            return defer.succeed(False)
+        self.nextPage += 1
+        
+        self.online[page] = []
+        d = self.getPage(page, lambda member: self.addMember(page, member))
+        d.addCallback(self.pageDone, page)
+        d.addErrback(self.pageFailed)
+        return d
+    
+    def addMember(self, page, member):
+        name = member.get("username")
+        if member.get("online") and name not in self.seen:
+            self.seen.add(name)
+            self.online[page].append(name)
+    
+    def pageDone(self, result, page):
+        count, lastPage = result if result is not None else (None, None)
+        if count is None or count < self.pageSize:
+            if count is None and page == 1:
+                self.found = False
+            lastPage = page
+        if lastPage is not None and (self.lastPage is None or lastPage < self.lastPage):
+            self.lastPage = lastPage
+        return True
+    
+    def pageFailed(self, failure):
+        # Stop the other workers from starting any more pages
+        self.lastPage = 0
+        return failure
+    
+    def result(self, ignored):
+        if not self.found:
+            return None
+        names = []
+        for page in sorted(self.online):
+            names.extend(self.online[page])
+        return names
+    
+    def failed(self, failure):
+        if failure.check(defer.FirstError):
+            return failure.value.subFailure
+        return failure
+
+
+class ResponseCache(object):
+    """
+    A bounded cache of Deferred results that expire after a time to live. While a value is being fetched, any other
+    request for the same key waits on that fetch instead of starting its own
+    """
+    
+    def __init__(self, max_entries=1000, clock=reactor):
+        """
+        Keyword arguments:
+        max_entries -- the most results to keep, least recently used are dropped first
+        clock       -- provides seconds(), the reactor by default
+        """
+        
+        self.max_entries = max_entries
+        self.clock = clock
+        # key ---> (expiry time, result), least recently used first
+        self.entries = collections.OrderedDict()
+        # key ---> list of Deferreds waiting on the fetch in flight
+        self.pending = {}
+        
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+    
+    def get(self, key, ttl, fetch):
+        """
+        Returns a Deferred that fires with the cached result for key, or with the result of fetch() if there isn't
+        one. Failures are passed on to every waiter but not cached
+        
+        Keyword arguments:
+        key   -- what the result is cached under
+        ttl   -- seconds a fresh result stays in the cache
+        fetch -- called with no arguments to get a Deferred for the result
+        """
+        
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            if entry[0] > self.clock.seconds():
+                self.hits += 1
+                self.entries[key] = entry
+                return defer.succeed(entry[1])
+        
+        if key in self.pending:
+            self.coalesced += 1
+            d = defer.Deferred()
+            self.pending[key].append(d)
+            return d
+        
+        self.misses += 1
+        self.pending[key] = []
+        
+        def done(result):
+            waiters = self.pending.pop(key, [])
+            if not isinstance(result, failure.Failure):
+                self.put(key, ttl, result)
+            for d in waiters:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+            return result
+        
+        d = defer.maybeDeferred(fetch)
+        d.addBoth(done)
+        return d
+    
+    def put(self, key, ttl, result):
+        """
+        Stores a result, dropping the least recently used ones if the cache is full
+        
+        Keyword arguments:
+        key    -- what the result is cached under
+        ttl    -- seconds the result stays in the cache
+        result -- the result to store
+        """
+        
+        self.entries.pop(key, None)
+        self.entries[key] = (self.clock.seconds() + ttl, result)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    
+    def stats(self):
+        """
+        Returns the cache counters as a dict
+        
+        Keyword arguments:
+        """
+        
+        return {
+            "entries": len(self.entries),
+            "in_flight": len(self.pending),
+            "hits_total": self.hits,
+            "misses_total": self.misses,
+            "coalesced_total": self.coalesced,
+            "evictions_total": self.evictions,
+        }
+
+
+class MoveCacheNode(object):
+    __slots__ = ("parent", "move", "san", "snapshot", "children", "size")
+    
+    def __init__(self, parent, move, san, snapshot):
+        """
+        Keyword arguments:
+        parent   -- the children dict of the node before this one, which this node is stored in
+        move     -- the (cleaned) move leading to this node
+        san      -- the same move in SAN, or None until someone asks for it
+        snapshot -- the position after the move, from ChessGame.snapshot()
+        """
+        
+        self.parent = parent
+        self.move = move
+        self.san = san
+        self.snapshot = snapshot
+        # Most positions are the end of a line, so the dict of positions after this one is only made when needed
+        self.children = None
+        self.size = (sys.getsizeof(self) + sys.getsizeof(san) + sys.getsizeof(snapshot) + sys.getsizeof(snapshot.board) +
+                     MoveCache.node_overhead)
+
+
+class MoveCache(object):
+    """
+    A bounded cache of positions reached by playing move lists from the starting position. Positions are kept in a
+    trie keyed by move, so a move list resumes from the longest prefix it shares with any earlier list and only the
+    rest of it is parsed. Least recently used positions are dropped when the cache holds more than max_entries
+    positions or more than max_bytes (estimated) of them.
+    """
+    
+    # Rough size of a MoveCacheNode's entries in its parent's dict and the LRU, on top of the node and snapshot
+    node_overhead = 250
+    
+    def __init__(self, max_entries=50000, max_bytes=32*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.root = {}
+        # MoveCacheNode ---> None, least recently used first
+        self.lru = collections.OrderedDict()
+        self.size = 0
+        
+        # Move lists that resumed from a cached position / started from scratch
+        self.hits = 0
+        self.misses = 0
+        # Plies skipped thanks to the cache / plies that had to be parsed
+        self.pliesReused = 0
+        self.pliesParsed = 0
+        self.evictions = 0
+    
+    def play(self, game, moves, san=None):
+        """
+        Sets the game to the position reached by playing the moves given from the starting position, reusing cached
+        positions where possible. Returns True or False depending on if every move was legal
+        
+        Keyword arguments:
+        game  -- the ChessGame to play the moves on
+        moves -- the list of moves to be played
+        san   -- a list to add each move played to in SAN, or None
+        """
+        
+        split = game.moveSplit(moves)
+        keys = [game.moveClean(a) for a in split]
+        
+        # Find the longest cached prefix
+        node = None
+        children = self.root
+        path = []
+        for key in keys:
+            child = children.get(key) if children is not None else None
+            if child is None:
+                break
+            node = child
+            children = node.children
+            path.append(node)
+        
+        reused = len(path)
+        if node is None:
+            self.misses += 1
+            if game.setFEN(ChessGame.fen_startpos) == False:
+                return False
+        else:
+            self.hits += 1
+            game.restore(node.snapshot)
+        self.pliesReused += reused
+        if san is not None:
+            if any(a.san is None for a in path):
+                self.fillSAN(game, path)
+            san.extend(a.san for a in path)
+        
+        # Parse the rest, caching every new position along the way. Working out SAN costs about as much as playing
+        # the move, so it's only done when asked for
+        r = True
+        try:
+            for a in range(reused, len(split)):
+                if san is not None:
+                    move = game.pushSAN(split[a])
+                    if move is None:
+                        r = False
+                        break
+                    san.append(move)
+                else:
+                    move = None
+                    if game.push(split[a]) == False:
+                        r = False
+                        break
+                game.findOpening()
+                self.pliesParsed += 1
+                
+                if children is None:
+                    children = node.children = {}
+                node = MoveCacheNode(children, keys[a], move, game.snapshot())
+                children[keys[a]] = node
+                children = node.children
+                self.size += node.size
+                path.append(node)
+        finally:
+            # Mark the path as recently used, even if a move raised, so every node in the trie is in the LRU and can be
+            # evicted. Deepest position first so a position is always more recently used than the positions after it,
+            # and eviction only ever removes the end of a line
+            for node in reversed(path):
+                self.lru.pop(node, None)
+                self.lru[node] = None
+        
+        self.trim()
+        return r
+    
+    def fillSAN(self, game, path):
+        """
+        Works out the SAN of the moves on a path that were cached without it, then sets the game back to the
+        position at the end of the path
+        
+        Keyword arguments:
+        game -- the ChessGame to replay the moves on
+        path -- the MoveCacheNodes from the first move onwards
+        """
+        
+        for a, node in enumerate(path):
+            if node.san is not None:
+                continue
+            if a == 0:
+                game.setFEN(ChessGame.fen_startpos)
+            else:
+                game.restore(path[a-1].snapshot)
+            node.san = game.pushSAN(node.move)
+            grown = sys.getsizeof(node.san) - sys.getsizeof(None)
+            node.size += grown
+            self.size += grown
+        game.restore(path[-1].snapshot)
+    
+    def trim(self):
+        """
+        Drops least recently used positions until the cache is back within its limits
+        
+        Keyword arguments:
+        """
+        
+        while self.lru and (len(self.lru) > self.max_entries or self.size > self.max_bytes):
+            node, _ = self.lru.popitem(last=False)
+            self.remove(node)
+    
+    def remove(self, node):
+        """
+        Removes a position, and any positions after it, from the cache
+        
+        Keyword arguments:
+        node -- the MoveCacheNode to remove
+        """
+        
+        if node.parent.get(node.move) is node:
+            del node.parent[node.move]
+        self.size -= node.size
+        self.evictions += 1
+        
+        for child in (node.children or {}).values():
+            self.lru.pop(child, None)
+            self.remove(child)
+    
+    def stats(self):
+        """
+        Returns the cache counters as a dict
+        
+        Keyword arguments:
+        """
+        
+        return {
+            "entries": len(self.lru),
+            "bytes": self.size,
+            "hits_total": self.hits,
+            "misses_total": self.misses,
+            "plies_reused_total": self.pliesReused,
+            "plies_parsed_total": self.pliesParsed,
+            "evictions_total": self.evictions,
+        }
+
+
+def buildOpeningBook(tsvPath, indexPath):
+    """
+    Plays every opening in a tab separated file from the starting position and writes an index of the position
+    each one ends in with openings.build(). Lines whose moves aren't legal are logged and left out. Returns how
+    many positions were written
+    
+    Keyword arguments:
+    tsvPath   -- the file of openings, with eco, name and pgn columns
+    indexPath -- the index file to write
+    """
+    
+    game = ChessGame()
+    check = game.zobrist
+    entries = []
+    depth = 0
+    for eco, name, moves in openings.readTSV(tsvPath):
+        game.setFEN(ChessGame.fen_startpos)
+        split = game.moveSplit(moves)
+        if game.playMoves(split) == False:
+            log.msg("Skipping opening {} {}: illegal moves {}".format(eco, name, moves))
+            continue
+        entries.append((game.openingKey(), eco, name))
+        depth = max(depth, len(split))
+    return openings.build(entries, indexPath, check, depth)
+
+def loadOpeningBook(tsvPath, indexPath):
+    """
+    Returns an OpeningBook mapping the index of the openings given, building the index first if it's missing or
+    older than the file of openings, and again if it can't be read or was made with different Zobrist keys. The
+    index is only a cache, so if there's no book to load or it can't be built this logs why and returns None
+    
+    Keyword arguments:
+    tsvPath   -- the file of openings, with eco, name and pgn columns
+    indexPath -- where the index is kept
+    """
+    
+    def openIndex():
+        book = openings.OpeningBook(indexPath)
+        if book.check != ChessGame().zobrist:
+            book.close()
+            raise ValueError("{} was built with different Zobrist keys".format(indexPath))
+        return book
+    
+    try:
+        haveTSV = os.path.exists(tsvPath)
+        if haveTSV and (not os.path.exists(indexPath) or os.path.getmtime(indexPath) < os.path.getmtime(tsvPath)):
+            buildOpeningBook(tsvPath, indexPath)
+        try:
+            return openIndex()
+        except (ValueError, struct.error, EnvironmentError) as e:
+            if not haveTSV:
+                raise
+            log.msg("Rebuilding {}: {}".format(indexPath, e))
+            buildOpeningBook(tsvPath, indexPath)
+            return openIndex()
+    except (ValueError, struct.error, EnvironmentError) as e:
+        log.msg("Not naming openings: {}".format(e))
+        return None
+
+
+class BoardError(Exception):
+    """
+    Raised when a !board move list can't be parsed in the worker pool, because it ran out of CPU time or the queue
+    is full
+    """
+
+
+# The board, cache, CPU limit and opening book of a BoardPool worker process, set up by _boardWorkerInit
+_workerGame = None
+_workerCache = None
+_workerCpuLimit = None
+_workerBook = None
+
+def _boardWorkerInit(cpuLimit, bookPath):
+    global _workerGame, _workerCache, _workerCpuLimit, _workerBook
+    # Every worker maps the same index, so the pages are shared between them. A worker that can't map it names no
+    # openings rather than failing to start, which the pool would retry forever
+    if bookPath is not None:
+        try:
+            _workerBook = openings.OpeningBook(bookPath)
+        except (ValueError, struct.error, EnvironmentError) as e:
+            log.msg("Not naming openings in this worker: {}".format(e))
+    _workerGame = ChessGame()
+    _workerGame.book = _workerBook
+    _workerCache = MoveCache()
+    _workerCpuLimit = cpuLimit
+    signal.signal(signal.SIGPROF, _boardWorkerTimeout)
+
+def _boardWorkerTimeout(signum, frame):
+    raise BoardError("That move list took too long to check")
+
+def _boardWorkerJob(moves):
+    """
+    Runs in a worker process. Returns ("ok", (URL or False, the moves played in SAN, the opening reached)) from
+    getLichessURL, or ("timeout", message) or ("failed", message) if it ran out of CPU time or raised. Never raises
+    
+    Keyword arguments:
+    moves -- the move list given to !board
+    """
+    
+    global _workerGame, _workerCache
+    try:
+        try:
+            # ITIMER_PROF counts the CPU time this process uses, not time spent waiting
+            signal.setitimer(signal.ITIMER_PROF, _workerCpuLimit)
+            san = []
+            url = _workerGame.getLichessURL(moves, _workerCache, san)
+            return "ok", (url, san, _workerGame.opening)
+        finally:
+            # The timer fires once, so if it goes off in here it has already been spent and the outer handler
+            # can't be interrupted by it again
+            signal.setitimer(signal.ITIMER_PROF, 0)
+    except BoardError as e:
+        status, message = "timeout", str(e)
+    except Exception:
+        log.err(None, "Checking !board {!r} failed".format(moves))
+        status, message = "failed", "Couldn't check that move list"
+    
+    # The board and cache could have been left half updated
+    _workerGame = ChessGame()
+    _workerGame.book = _workerBook
+    _workerCache = MoveCache()
+    return status, message
+
+
+class BoardPool(object):
+    """
+    Parses !board move lists in worker processes so long ones don't hold up the reactor. Each worker keeps its own
+    MoveCache
+    """
+    
+    def __init__(self, workers, cpuLimit, maxQueued, bookPath=None, timeout=30, clock=reactor):
+        """
+        Keyword arguments:
+        workers   -- how many worker processes to start
+        cpuLimit  -- seconds of CPU time one move list may take
+        maxQueued -- the most move lists waiting or being parsed before new ones are turned away
+        bookPath  -- the opening book index for the workers to name openings from, or None
+        timeout   -- seconds to wait for a move list's answer, queueing included, before giving up on it; this is
+                     what frees the slot if a worker dies with the move list
+        clock     -- what to schedule the timeouts with
+        """
+        
+        self.pool = multiprocessing.Pool(workers, _boardWorkerInit, (cpuLimit, bookPath))
+        self.maxQueued = maxQueued
+        self.timeout = timeout
+        self.clock = clock
+        self.queued = 0
+        self.rejected = 0
+        self.timedOut = 0
+        self.failed = 0
+    
+    def submit(self, moves):
+        """
+        Returns a Deferred that fires with (what getLichessURL returns for the moves, the moves played in SAN, the
+        opening reached), or fails with BoardError
+        
+        Keyword arguments:
+        moves -- the move list given to !board
+        """
+        
+        if self.queued >= self.maxQueued:
+            self.rejected += 1
+            return defer.fail(BoardError("Too many boards to check right now, try again later"))
+        
+        d = defer.Deferred()
+        self.queued += 1
+        
+        def finished(result):
+            # An answer that arrives after the timeout has nowhere to go
+            if not timer.active():
+                return
+            timer.cancel()
+            self.queued -= 1
+            status, value = result
+            if status == "ok":
+                d.callback(value)
+                return
+            if status == "timeout":
+                self.timedOut += 1
+            else:
+                self.failed += 1
+            d.errback(BoardError(value))
+        
+        def expired():
+            self.queued -= 1
+            self.timedOut += 1
+            d.errback(BoardError("That move list took too long to check"))
+        
+        timer = self.clock.callLater(self.timeout, expired)
+        # The callback runs in one of the pool's threads, so hand the result back to the reactor
+        self.pool.apply_async(_boardWorkerJob, (moves,), callback=lambda result: reactor.callFromThread(finished, result))
+        return d
+    
+    def stats(self):
+        """
+        Returns the queue counters as a dict
+        
+        Keyword arguments:
+        """
+        
+        return {
+            "queued": self.queued,
+            "rejected_total": self.rejected,
+            "timed_out_total": self.timedOut,
+            "failed_total": self.failed,
+        }
+    
+    def stop(self):
+        """
+        Kills the worker processes
+        
+        Keyword arguments:
+        """
+        
+        self.pool.terminate()
+
+
+class RateLimiter(object):
+    """
+    A token bucket for each key (a host or a channel). Each request spends tokens from its key's bucket and is
+    refused if there aren't enough, and buckets fill back up at a steady rate
+    """
+    
+    def __init__(self, rate, burst, maxKeys=10000, clock=reactor):
+        """
+        Keyword arguments:
+        rate    -- tokens added to each bucket per second
+        burst   -- the most tokens a bucket can hold
+        maxKeys -- how many buckets to keep before forgetting the least recently used ones
+        clock   -- provides seconds(), the reactor by default
+        """
+        
+        self.rate = float(rate)
+        self.burst = burst
+        self.maxKeys = maxKeys
+        self.clock = clock
+        # key ---> (tokens, time they were counted), least recently spent from first
+        self.buckets = collections.OrderedDict()
+        self.rejected = 0
+    
+    def tokens(self, key):
+        """
+        Returns how many tokens the key's bucket holds right now
+        
+        Keyword arguments:
+        key -- the host or channel the bucket belongs to
+        """
+        
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        tokens, updated = bucket
+        return min(self.burst, tokens + (self.clock.seconds() - updated) * self.rate)
+    
+    def take(self, key, cost):
+        """
+        Spends tokens from the key's bucket. A cost bigger than the bucket is charged as a full bucket, so every
+        request can get through eventually
+        
+        Keyword arguments:
+        key  -- the host or channel the bucket belongs to
+        cost -- the tokens to spend
+        """
+        
+        tokens = self.tokens(key) - min(cost, self.burst)
+        self.buckets.pop(key, None)
+        self.buckets[key] = (tokens, self.clock.seconds())
+        # The bucket spent from longest ago has had the longest to fill back up, and a full bucket is the same as no
+        # bucket at all
+        while len(self.buckets) > self.maxKeys:
+            self.buckets.popitem(last=False)
+    
+    def allows(self, key, cost):
+        """
+        Returns True or False depending on if the key's bucket has enough tokens for the cost
+        
+        Keyword arguments:
+        key  -- the host or channel the bucket belongs to
+        cost -- the tokens the request would spend
+        """
+        
+        return self.tokens(key) >= min(cost, self.burst)
+
+
+class SendQueue(object):
+    """
+    Holds outgoing messages and sends them no faster than a token bucket allows, so bursts of replies don't get the
+    bot kicked for flooding. Channel replies go before private ones, and targets of the same kind take turns
+    """
+    
+    def __init__(self, send, rate, burst, maxDepth, clock=reactor):
+        """
+        Keyword arguments:
+        send     -- called with (target, message) to actually send a message
+        rate     -- messages per second allowed once the burst is used up
+        burst    -- messages that can be sent at once after a quiet spell
+        maxDepth -- the most messages to hold for one target, the oldest are dropped beyond that
+        clock    -- provides seconds() and callLater(), the reactor by default
+        """
+        
+        self.send = send
+        self.rate = float(rate)
+        self.burst = burst
+        self.maxDepth = maxDepth
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock.seconds()
+        # target ---> deque of (time queued, message), in the order targets take turns
+        self.channels = collections.OrderedDict()
+        self.users = collections.OrderedDict()
+        self.call = None
+        
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+    
+    def put(self, target, msg):
+        """
+        Queues a message and sends whatever the bucket allows straight away. A message already waiting for the same
+        target is not queued twice
+        
+        Keyword arguments:
+        target -- the channel or nick to send to
+        msg    -- the message to send
+        """
+        
+        queues = self.channels if target[:1] in irc.CHANNEL_PREFIXES else self.users
+        queue = queues.get(target)
+        if queue is None:
+            queue = queues[target] = collections.deque()
+        
+        if any(queued == msg for t, queued in queue):
+            self.merged += 1
+            return
+        if len(queue) >= self.maxDepth:
+            queue.popleft()
+            self.dropped += 1
+        queue.append((self.clock.seconds(), msg))
+        self.flush()
+    
+    def flush(self):
+        """
+        Sends queued messages while there are tokens for them, and schedules another flush for when the next token
+        is due
+        
+        Keyword arguments:
+        """
         
-        if self.onBoard(secondChunk) == False:
-            return False;
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
         
-        if len(move) == 4:
-            if self.onBoard(firstChunk) == False:
-                return False;
-            hint_col = self.posGetCol(firstChunk)
-            hint_row = self.posGetRow(firstChunk)
-            move = move[2:]
-            piece_type = self.boardGet(hint_col, hint_row)
-        elif len(move) == 3:
-            if firstChunk != secondChunk:
-                if firstChunk[0].isalpha() == True:
-                    hint_col = self.charToCol(firstChunk[0])
-                else:
-                    hint_row = self.charToRow(firstChunk[0])
-                move = move[1:]
-        elif len(move) == 2:
-            pass
-        else:
-            return False
+        while self.tokens >= 1:
+            queues = self.channels or self.users
+            if not queues:
+                break
+            # Take the next target's turn and put it to the back if it has more waiting
+            target, queue = queues.popitem(last=False)
+            queued, msg = queue.popleft()
+            if queue:
+                queues[target] = queue
             
-        # Convert the move to col & row
-        col_to = self.posGetCol(move)
-        row_to = self.posGetRow(move)
+            self.tokens -= 1
+            self.sent += 1
+            self.waitTotal += now - queued
+            self.waitMax = max(self.waitMax, now - queued)
+            self.send(target, msg)
+        
+        if (self.channels or self.users) and self.call is None:
+            self.call = self.clock.callLater((1 - self.tokens) / self.rate, self._wake)
+    
+    def _wake(self):
+        self.call = None
+        self.flush()
+    
+    def stop(self):
+        """
+        Throws away everything still queued and cancels the next flush
         
-        # Can't promote pieces other than pawns
-        if self.turn == "w":
-            if promotion != "-" and row_to != 7:
-                return False
-        elif self.turn == "n":
-            if promotion != "-" and row_to != 0:
-                return False
+        Keyword arguments:
+        """
         
-        # Create a list of candidate moves
-        moves_found = []
-        if self.turn == "w":
-            moves_found += self.findMoveWP(col_to, row_to)
-            moves_found += self.findMoveN("N", col_to, row_to)
-            moves_found += self.findMoveDiagonal("B", col_to, row_to)
-            moves_found += self.findMoveStraight("R", col_to, row_to)
-            moves_found += self.findMoveDiagonal("Q", col_to, row_to)
-            moves_found += self.findMoveStraight("Q", col_to, row_to)
-            moves_found += self.findMoveKing("K", col_to, row_to)
-        elif self.turn == "b":
-            moves_found += self.findMoveBP(col_to, row_to)
-            moves_found += self.findMoveN("n", col_to, row_to)
-            moves_found += self.findMoveDiagonal("b", col_to, row_to)
-            moves_found += self.findMoveStraight("r", col_to, row_to)
-            moves_found += self.findMoveDiagonal("q", col_to, row_to)
-            moves_found += self.findMoveStraight("q", col_to, row_to)
-            moves_found += self.findMoveKing("k", col_to, row_to)
-        
-        # Move must've been illegal
-        if moves_found == []:
-            return False
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        self.channels.clear()
+        self.users.clear()
+    
+    def depth(self):
+        """
+        Returns how many messages are waiting to be sent
         
-        # Compare the moves to the piece type and the hint (if any)
-        for a in moves_found:
-            if a[0].upper() != piece_type.upper():
-                continue
-            
-            if hint_col != -1 and a[1] != hint_col:
-                continue;
-            if hint_row != -1 and a[2] != hint_row:
-                continue;
-            
-            self.moveMake(a[1], a[2], col_to, row_to, promotion)
-            return True
+        Keyword arguments:
+        """
         
-        # Didn't find any matches
-        return False
+        return sum(len(q) for q in self.channels.values()) + sum(len(q) for q in self.users.values())
     
-    def moveParses(self, moves):
+    def stats(self):
         """
-        Parses the list of moves given and plays them
+        Returns the queue counters as a dict, with waits in seconds
         
         Keyword arguments:
-        moves -- the list of moves to be played
         """
         
-        split = moves.split(" ")
+        return {
+            "queued": self.depth(),
+            "sent_total": self.sent,
+            "merged_total": self.merged,
+            "dropped_total": self.dropped,
+            "wait_avg": self.waitTotal / self.sent if self.sent else 0.0,
+            "wait_max": self.waitMax,
+        }
+
+
+class StallWatchdog(object):
+    """
+    Notices when the reactor was blocked for longer than a threshold, by checking how late a regular heartbeat runs,
+    and logs the slowest command that ran since the last heartbeat
+    """
+    
+    def __init__(self, threshold, interval, metrics, clock=reactor):
+        """
+        Keyword arguments:
+        threshold -- seconds late a heartbeat must be to count as a stall
+        interval  -- seconds between heartbeats
+        metrics   -- the Metrics to record reactor lag in
+        clock     -- provides seconds() and callLater(), the reactor by default
+        """
         
-        for a in split:
-            if a == '':
-                continue
-            if a[0].isdigit() == True:
-                continue
-            
-            if self.moveParse(a) == False:
-                return False
-            
-            # Find king positions
-            wK_col = 0
-            wK_row = 0
-            bK_col = 0
-            bK_row = 0
-            for x in range(0, 8):
-                for y in range(0, 8):
-                    if self.boardGet(x, y) == "K":
-                        wK_col = x
-                        wK_row = y
-                    if self.boardGet(x, y) == "k":
-                        bK_col = x
-                        bK_row = y
-            
-            if self.turn == "w":
-                self.turn = "b"
-                # See if the move put us in check
-                if self.isBlackAttacking(wK_col, wK_row) == True:
-                    return False
-            elif self.turn == "b":
-                self.turn = "w"
-                self.fullMoves += 1
-                # See if the move put us in check
-                if self.isWhiteAttacking(bK_col, bK_row) == True:
-                    return False
-            
-        return True
+        self.threshold = threshold
+        self.interval = interval
+        self.metrics = metrics
+        self.clock = clock
+        self.loop = None
+        self.last = None
+        self.stalls = 0
+        # The command that held the reactor longest since the last heartbeat, and for how long
+        self.slowest = None
+        self.slowestTime = 0.0
+    
+    def start(self):
+        self.last = self.clock.seconds()
+        self.loop = task.LoopingCall(self.beat)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval, now=False)
+    
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+    
+    def noteCommand(self, description, elapsed):
+        """
+        Remembers a command if it held the reactor longer than any other since the last heartbeat
         
-    def test(self, fen, moves):
+        Keyword arguments:
+        description -- the command as it was sent
+        elapsed     -- seconds it ran on the reactor for
         """
-        Compares the FEN provided with the FEN calculated from parsing and playing the moves given
         
+        if elapsed >= self.slowestTime:
+            self.slowest = description
+            self.slowestTime = elapsed
+    
+    def beat(self):
+        now = self.clock.seconds()
+        lag = max(0.0, now - self.last - self.interval)
+        self.last = now
+        self.metrics.observe("chessbot_reactor_lag_seconds", lag)
+        
+        if lag > self.threshold:
+            self.stalls += 1
+            self.metrics.inc("chessbot_reactor_stalls_total")
+            if self.slowest is None:
+                log.msg("Reactor stalled for {:.3f}s, no command ran".format(lag))
+            else:
+                log.msg("Reactor stalled for {:.3f}s, slowest command was {!r} taking {:.3f}s".format(
+                    lag, self.slowest, self.slowestTime))
+        
+        self.slowest = None
+        self.slowestTime = 0.0
+
+
+class CommandProfiler(object):
+    """
+    Runs cProfile over the next few commands on request and writes the stats to a file. Only the part of a command
+    that runs straight away is profiled, not callbacks that run later such as Lichess replies
+    """
+    
+    def __init__(self, directory):
+        """
         Keyword arguments:
-        fen   -- the expected board position in FEN notation
-        moves -- the list of moves to be played
+        directory -- where to write the .prof files
         """
         
-        # Check the FEN provided is accurate before trying to test the moves against it
-        r = self.setFEN(fen)
-        if r == False:
-            print("Invalid FEN:   {}".format(fen))
-            return
+        self.directory = directory
+        self.profile = None
+        self.remaining = 0
+    
+    def start(self, commands):
+        """
+        Starts profiling, throwing away any profile already running
         
-        # Reset to startpos FEN
-        r = self.setFEN(ChessGame.fen_startpos)
-        if r == False:
-            print("Invalid start FEN: {}".format(ChessGame.fen_startpos))
-            return
+        Keyword arguments:
+        commands -- how many commands to profile
+        """
         
-        # Play the moves provided
-        r = self.moveParses(moves)
-        if r == False:
-            print("Invalid moves: {}".format(moves))
-            return
+        self.profile = cProfile.Profile()
+        self.remaining = commands
+    
+    def stop(self):
+        """
+        Stops profiling and returns the path the stats were written to
         
-        # Get the FEN from the board now the moves have been played
-        r = self.getFEN()
-        if r == False:
-            print("Invalid FEN:   {}".format(fen))
-            return
+        Keyword arguments:
+        """
         
-        if self.fen == fen:
-            print("Passed: {}".format(moves))
-        else:
-            print("Failed: {}".format(moves))
+        path = os.path.join(self.directory, "chessbot-{}.prof".format(time.strftime("%Y%m%d-%H%M%S")))
+        self.profile.dump_stats(path)
+        self.profile = None
+        return path
+    
+    def call(self, func, *args):
+        """
+        Calls func, under the profiler if it is running
         
-        #print("Fen:   {}".format(fen))
-        #print("Moves: {}".format(moves))
+        Keyword arguments:
+        func -- the function to call
+        args -- the arguments to call it with
+        """
+        
+        profile = self.profile
+        if profile is None:
+            return func(*args)
+        
+        profile.enable()
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            # func could have stopped or restarted the profiler itself
+            if self.profile is profile:
+                self.remaining -= 1
+                if self.remaining <= 0:
+                    log.msg("Wrote profile to {}".format(self.stop()))
+
 
 class ChessBotIRCProtocol(irc.IRCClient):
     nickname = 'ChessBot'
+    
+    # Flood control: replies per second, how many can go out at once after a
+    # quiet spell, and how many to hold per target before dropping the oldest
+    sendRate = 1.0
+    sendBurst = 4
+    sendQueueDepth = 10
+    # Admission control: tokens per second and bucket size for each host and
+    # each channel, what each command costs, and how many !board moves cost
+    # one token more
+    userRate = 0.2
+    userBurst = 5
+    channelRate = 1.0
+    channelBurst = 10
+    commandCosts = {"team": 3}
+    boardMovesPerToken = 40
 
     def __init__(self):
         self.deferred = defer.Deferred()
         self.ops = ['Twipply', 'Miffo', 'qed', 'NIN101', 'mekhami']
+        # One board shared by every !board request; getLichessURL resets it each time
+        self.game = ChessGame()
+        self.sendQueue = SendQueue(self.msg, self.sendRate, self.sendBurst, self.sendQueueDepth)
+        self.userLimiter = RateLimiter(self.userRate, self.userBurst)
+        self.channelLimiter = RateLimiter(self.channelRate, self.channelBurst)
+
+    def connectionMade(self):
+        irc.IRCClient.connectionMade(self)
+        self.game.book = self.factory.openingBook
+        self.factory.metrics.addCollector("chessbot_send_queue", self.sendQueue.stats)
 
     def connectionLost(self, reason):
+        self.sendQueue.stop()
         self.deferred.errback(reason)
 
     def signedOn(self):
@@ -1015,22 +3080,91 @@ class ChessBotIRCProtocol(irc.IRCClient):
         if channel == self.nickname:
             # When channel == self.nickname, the message was sent to the bot
             # directly and not to a channel. So we will answer directly too:
-            d = defer.maybeDeferred(func, rest, user)
+            if not self.admit(host or nick, None, command, rest):
+                return
+            d = self.runCommand(command, func, rest, user)
             d.addErrback(self._showError)
             d.addCallback(self._sendMessage, nick)
         else:
             if command == "board" or command == "help" or command == "quit":
                 # Otherwise, send the answer to the channel, and use the nick
                 # as addressing in the message itself:
-                d = defer.maybeDeferred(func, rest, user)
+                if not self.admit(host or nick, channel, command, rest):
+                    return
+                d = self.runCommand(command, func, rest, user)
                 d.addErrback(self._showError)
                 d.addCallback(self._sendMessage, channel)
             else:
                 # Send them a message saying to use /msg
                 pass
 
+    def commandCost(self, command, rest):
+        """
+        Returns the tokens a command costs, without parsing its arguments
+        
+        Keyword arguments:
+        command -- the command name, without the !
+        rest    -- everything after the command
+        """
+        
+        cost = self.commandCosts.get(command, 1)
+        if command == "board":
+            cost += rest.count(" ") // self.boardMovesPerToken
+        return cost
+    
+    def admit(self, host, channel, command, rest):
+        """
+        Returns True or False depending on if the sender's and the channel's buckets can both pay for the command,
+        spending the tokens if so
+        
+        Keyword arguments:
+        host    -- the sender's host, or nick if there isn't one
+        channel -- the channel the command was sent to, None for private messages
+        command -- the command name, without the !
+        rest    -- everything after the command
+        """
+        
+        cost = self.commandCost(command, rest)
+        if not self.userLimiter.allows(host, cost):
+            self.userLimiter.rejected += 1
+            self.factory.metrics.inc("chessbot_commands_rejected_total", {"command": command, "limit": "user"})
+            return False
+        if channel is not None:
+            if not self.channelLimiter.allows(channel, cost):
+                self.channelLimiter.rejected += 1
+                self.factory.metrics.inc("chessbot_commands_rejected_total", {"command": command, "limit": "channel"})
+                return False
+            self.channelLimiter.take(channel, cost)
+        self.userLimiter.take(host, cost)
+        return True
+    
+    def runCommand(self, command, func, rest, user):
+        """
+        Calls a command's function through maybeDeferred, counting it and timing both the part that runs on the
+        reactor and how long it takes until the answer is ready
+        
+        Keyword arguments:
+        command -- the command name, without the !
+        func    -- the command_* method
+        rest    -- everything after the command
+        user    -- the full nick!user@host of the sender
+        """
+        
+        metrics = self.factory.metrics
+        labels = {"command": command}
+        metrics.inc("chessbot_commands_total", labels)
+        
+        start = time.time()
+        d = defer.maybeDeferred(self.factory.profiler.call, func, rest, user)
+        elapsed = time.time() - start
+        metrics.observe("chessbot_command_reactor_seconds", elapsed, labels)
+        self.factory.watchdog.noteCommand("!{} {}".format(command, rest)[:80], elapsed)
+        return metrics.timeDeferred(d, "chessbot_command_seconds", labels, "chessbot_command_errors_total")
+    
     def _sendMessage(self, msg, target):
-        self.msg(target, msg)
+        if msg is None:
+            return
+        self.sendQueue.put(target, msg)
 
     def _showError(self, failure):
         return failure.getErrorMessage()
@@ -1041,70 +3175,521 @@ class ChessBotIRCProtocol(irc.IRCClient):
         else:
             return "Permission denied."
     
+    def command_profile(self, rest, user):
+        if not any([user.startswith(x) for x in self.ops]):
+            return "Permission denied."
+        
+        profiler = self.factory.profiler
+        if rest in ("off", "stop"):
+            if profiler.profile is None:
+                return "Not profiling"
+            return "Wrote profile to {}".format(profiler.stop())
+        
+        try:
+            commands = int(rest) if rest else 10
+        except ValueError:
+            return "Usage: !profile [commands|off]"
+        profiler.start(commands)
+        return "Profiling the next {} commands".format(commands)
+    
     def command_help(self, rest, user):
         return "IRC bot for ##chess on irc.freenode.org - https://github.com/mekhami/ChessBot#readme"
     
     def command_board(self, rest, user):
-        game = ChessGame()
-        
         if rest == "":
             return "Usage: !board <moves>"
         
-        r = game.getLichessURL(rest)
+        if self.factory.boardPool is not None:
+            d = self.factory.boardPool.submit(rest)
+            d.addCallback(self._boardReply, rest)
+            return d
         
-        if r == False:
+        san = []
+        url = self.game.getLichessURL(rest, self.factory.boardCache, san)
+        return self._boardReply((url, san, self.game.opening), rest)
+    
+    def _boardReply(self, result, rest):
+        url, san, opening = result
+        if url != False:
+            if opening is not None:
+                url += " ({} {})".format(*opening)
+            if san == []:
+                return url
+            return self._boardMoves(url + " ", san)
+        
+        # The move that wasn't legal is the one after the last move played, given back as it was typed
+        moves = self.game.moveSplit(rest)
+        if len(san) >= len(moves):
             return "Invalid moves"
-        return r
+        illegal = "Illegal move: {}{} {}".format(len(san) // 2 + 1, "..." if len(san) % 2 else ".", moves[len(san)])
+        if san == []:
+            return illegal
+        return self._boardMoves(illegal + " after ", san)
+    
+    def _boardMoves(self, prefix, san):
+        """
+        Returns a !board reply ending with the moves of the game in SAN with move numbers, keeping only the end of
+        the game if all of it wouldn't fit on one line
+        
+        Keyword arguments:
+        prefix -- the start of the reply
+        san    -- the moves, in SAN
+        """
+        
+        text = self.game.moveJoin(san)
+        limit = max(self.factory.boardReplyLength - len(prefix) - 4, 0)
+        if len(text) > limit:
+            # Cut at a space so no move is left half shown
+            text = "... " + text[len(text)-limit:].split(" ", 1)[-1]
+        return prefix + text
+    
+    def lichessRequest(self, url, gotResponse):
+        """
+        Requests a URL from Lichess once the connection pool has a free slot, keeping the slot until gotResponse's
+        result is ready. Returns a Deferred that fires with that result
+        
+        Keyword arguments:
+        url         -- the URL to request
+        gotResponse -- called with the response, returns the result or a Deferred of it
+        """
+        
+        def request():
+            d = self.factory.agent.request("GET", url, Headers({"User-Agent": ["ChessBot"]}))
+            d.addCallback(gotResponse)
+            d.addErrback(cancelled)
+            return d
+        
+        def cancelled(failure):
+            # A request cancelled once it has been sent fails with the CancelledError wrapped up, which addTimeout()
+            # wouldn't recognise as its own and report as a timeout
+            failure.trap(ResponseNeverReceived, ResponseFailed)
+            if all(reason.check(defer.CancelledError) for reason in failure.value.reasons):
+                raise defer.CancelledError()
+            return failure
+        
+        return self.factory.pool.run(request)
+    
+    def getJSON(self, path, endpoint="api"):
+        """
+        Requests a path from the Lichess API without blocking the reactor. Returns a Deferred that fires with the
+        decoded JSON body, or None if Lichess says the path doesn't exist
+        
+        Keyword arguments:
+        path     -- the path to request, e.g. /api/user/thibault
+        endpoint -- what kind of request it is, for the metrics
+        """
+        
+        url = self.factory.lichessURL + path
+        
+        def gotResponse(response):
+            if response.code == 404:
+                response.deliverBody(protocol.Protocol())
+                return None
+            if response.code != 200:
+                response.deliverBody(protocol.Protocol())
+                raise LichessError("{} returned HTTP {}".format(url, response.code))
+            
+            body = readBody(response)
+            body.addCallback(json.loads)
+            return body
+        
+        d = self.lichessRequest(url, gotResponse)
+        d.addTimeout(self.factory.lichessTimeout, reactor)
+        return self.factory.metrics.timeDeferred(d, "chessbot_lichess_request_seconds", {"endpoint": endpoint},
+                                                 "chessbot_lichess_errors_total")
+    
+    def getJSONCached(self, path, ttl, endpoint="api"):
+        """
+        Like getJSON, but answers from the factory's response cache while the result is younger than ttl, and shares
+        one request between everyone asking for the same path at the same time
+        
+        Keyword arguments:
+        path     -- the path to request, e.g. /api/user/thibault
+        ttl      -- seconds a result may be reused for
+        endpoint -- what kind of request it is, for the metrics
+        """
+        
+        return self.factory.lichessCache.get(path, ttl, lambda: self.getJSON(path, endpoint))
+    
+    def _lookupFailed(self, failure):
+        log.err(failure, "Lichess lookup failed")
+        return "Couldn't reach Lichess.org, try again later"
+    
+    def getTeamPage(self, team, page, onMember):
+        """
+        Requests one page of a team's roster, passing each member to onMember as it streams in. Returns a Deferred that
+        fires with the number of members on the page and the number of pages Lichess says there are (or None if it
+        doesn't say), or with None if Lichess says the page doesn't exist
+        
+        Keyword arguments:
+        team     -- the team's id on Lichess
+        page     -- the page number, starting at 1
+        onMember -- called with each member dict
+        """
+        
+        url = self.factory.lichessURL + "/api/user?team={}&nb={}&page={}".format(
+            urllib.quote(team), self.factory.lichessTeamPageSize, page)
+        
+        def gotResponse(response):
+            if response.code == 404:
+                response.deliverBody(protocol.Protocol())
+                return None
+            if response.code != 200:
+                response.deliverBody(protocol.Protocol())
+                raise LichessError("{} returned HTTP {}".format(url, response.code))
+            
+            def cancel(finished):
+                reader.transport.stopProducing()
+            
+            reader = TeamPageReader(defer.Deferred(cancel), onMember)
+            response.deliverBody(reader)
+            return reader.finished
+        
+        d = self.lichessRequest(url, gotResponse)
+        d.addTimeout(self.factory.lichessTimeout, reactor)
+        return self.factory.metrics.timeDeferred(d, "chessbot_lichess_request_seconds", {"endpoint": "team"},
+                                                 "chessbot_lichess_errors_total")
+    
+    def getTeam(self, team):
+        """
+        Returns a Deferred that fires with the usernames of a team's online members, or None if there is no such team
+        
+        Keyword arguments:
+        team -- the team's id on Lichess
+        """
+        
+        factory = self.factory
+        fetch = TeamRosterFetch(lambda page, onMember: self.getTeamPage(team, page, onMember),
+                                factory.lichessTeamPageSize, factory.lichessTeamParallel, factory.lichessTeamMaxPages)
+        return fetch.start()
     
     def command_team(self, team, user):
-        response = urllib2.urlopen("http://en.lichess.org/api/user?team={}&nb=100".format(team))
-        data = json.load(response)
-
+        d = self.factory.lichessCache.get("team:" + team, self.factory.lichessTeamTTL, lambda: self.getTeam(team))
+        d.addCallback(self._teamReply, team)
+        d.addErrback(self._lookupFailed)
+        return d
+    
+    def _teamReply(self, data, team):
+        if data is None:
+            return "{} was not found on Lichess.org".format(team)
+        
         online_users = ""
         
-        for a in data['list']:
-            if a['online']:
-                online_users += " {}".format(a['username'])
+        # Stop listing names once the rest wouldn't fit on one line, and say how many were left out
+        for i, name in enumerate(data):
+            left = len(data) - i - 1
+            more = " and {} more".format(left) if left else ""
+            if len(online_users) + len(name) + 1 + len(more) > self.factory.teamReplyLength:
+                online_users += " and {} more".format(left + 1)
+                break
+            online_users += " {}".format(name)
 
         return "{} players online:{}".format(team, online_users)
 
     def command_live(self, player, user):
         if player and len(player) <= 16:
-            try:
-                response = urllib2.urlopen("http://en.lichess.org/api/user/" + player)
-                data = json.load(response)
-                
-                if data['online'] == False:
-                    return "{} is currently offline on Lichess.org".format(player)
-                
-                url = data['playing']
-                
-                return "{} is playing at {}".format(player, data['playing'])
-            except urllib2.HTTPError as err:
-                if err.code == 404:
-                    return "{} was not found on Lichess.org".format(player)
-                log.err()
-            except urllib2.URLError as err:
-                log.err()
-            except KeyError:
-                return "{} is not currently playing".format(player)
+            d = self.getJSONCached("/api/user/" + urllib.quote(player), self.factory.lichessUserTTL, "user")
+            d.addCallback(self._liveReply, player)
+            d.addErrback(self._lookupFailed)
+            return d
         else:
             # show all channel members on lichess
             pass
+    
+    def _liveReply(self, data, player):
+        if data is None:
+            return "{} was not found on Lichess.org".format(player)
+        
+        if data['online'] == False:
+            return "{} is currently offline on Lichess.org".format(player)
+        
+        if 'playing' not in data:
+            return "{} is not currently playing".format(player)
+        
+        return "{} is playing at {}".format(player, data['playing'])
 
 
 class ChessIRCFactory(protocol.ReconnectingClientFactory):
     protocol = ChessBotIRCProtocol
     channels = ['##chess']
+    
+    # Where the Lichess API lives, how long to wait for it before giving up,
+    # how many connections to have open to it at once and how long to keep
+    # idle ones open for (seconds)
+    lichessURL = "http://en.lichess.org"
+    lichessTimeout = 10
+    lichessMaxConnections = 4
+    lichessIdleTimeout = 120
+    # Seconds a user's status and a team's roster are reused for, and how many
+    # answers to keep
+    lichessUserTTL = 30
+    lichessTeamTTL = 300
+    lichessCacheSize = 1000
+    # Members asked for per page of a team roster, how many pages to request
+    # at once and at most, and how many characters of names to reply with
+    lichessTeamPageSize = 100
+    lichessTeamParallel = 3
+    lichessTeamMaxPages = 50
+    teamReplyLength = 350
+    # Worker processes to parse !board move lists in (0 parses them in the
+    # reactor), CPU seconds each move list may take there, and how many may
+    # be waiting at once
+    boardWorkers = 0
+    boardCpuLimit = 2.0
+    boardQueueLimit = 20
+    # Seconds a move list may wait for and use a worker before its reply is
+    # given up on
+    boardTimeout = 30
+    # Most characters to reply to !board with, the URL and game in SAN together
+    boardReplyLength = 350
+    # Where to publish metrics: a local port to serve them on for Prometheus
+    # and/or a file to write them to every metricsInterval seconds
+    metricsPort = None
+    metricsInterface = "127.0.0.1"
+    metricsFile = None
+    metricsInterval = 60
+    # Seconds the reactor must be held up for before it is logged as a
+    # stall, seconds between checks, and where !profile writes its stats
+    stallThreshold = 0.5
+    stallInterval = 0.1
+    profileDir = "."
+    # Openings to name in !board replies, with eco, name and pgn columns, and
+    # the index built from them that every game and worker maps
+    openingsFile = "openings.tsv"
+    openingsIndex = "openings.bin"
+    
+    def __init__(self):
+        self.openingBook = loadOpeningBook(self.openingsFile, self.openingsIndex)
+        # Positions reached by !board move lists, kept across reconnects
+        self.boardCache = MoveCache()
+        self.boardPool = None
+        if self.boardWorkers:
+            bookPath = self.openingsIndex if self.openingBook is not None else None
+            self.boardPool = BoardPool(self.boardWorkers, self.boardCpuLimit, self.boardQueueLimit, bookPath,
+                                       self.boardTimeout)
+            reactor.addSystemEventTrigger("before", "shutdown", self.boardPool.stop)
+        # Non-blocking HTTP client for the Lichess API, sharing keep-alive
+        # connections between every lookup
+        self.pool = LichessConnectionPool(reactor, self.lichessMaxConnections, self.lichessIdleTimeout)
+        self.agent = Agent(reactor, connectTimeout=self.lichessTimeout, pool=self.pool)
+        self.lichessCache = ResponseCache(self.lichessCacheSize)
+        
+        self.metrics = Metrics()
+        self.metrics.describe("chessbot_commands_total", "Commands run, by command")
+        self.metrics.describe("chessbot_commands_rejected_total", "Commands turned away by the rate limits")
+        self.metrics.describe("chessbot_command_errors_total", "Commands that failed with an exception")
+        self.metrics.describe("chessbot_command_reactor_seconds", "Time a command spent running on the reactor")
+        self.metrics.describe("chessbot_command_seconds", "Time from a command arriving to its answer being ready")
+        self.metrics.describe("chessbot_lichess_request_seconds", "Time Lichess API requests took")
+        self.metrics.describe("chessbot_lichess_errors_total", "Lichess API requests that failed or timed out")
+        self.metrics.addCollector("chessbot_board_cache", self.boardCache.stats)
+        self.metrics.addCollector("chessbot_lichess_cache", self.lichessCache.stats)
+        self.metrics.addCollector("chessbot_lichess_pool", self.pool.stats)
+        if self.boardPool is not None:
+            self.metrics.addCollector("chessbot_board_pool", self.boardPool.stats)
+        self.metrics.describe("chessbot_reactor_lag_seconds", "How late the reactor heartbeat ran")
+        self.metrics.describe("chessbot_reactor_stalls_total", "Heartbeats late by more than the stall threshold")
+        
+        self.watchdog = StallWatchdog(self.stallThreshold, self.stallInterval, self.metrics)
+        self.profiler = CommandProfiler(self.profileDir)
+    
+    def publishMetrics(self):
+        """
+        Starts serving and/or dumping the metrics as configured by metricsPort and metricsFile
+        
+        Keyword arguments:
+        """
+        
+        if self.metricsPort is not None:
+            reactor.listenTCP(self.metricsPort, server.Site(MetricsResource(self.metrics)), interface=self.metricsInterface)
+        if self.metricsFile is not None:
+            task.LoopingCall(self.metrics.dump, self.metricsFile).start(self.metricsInterval, now=False)
+
+# Reference positions with their known perft node counts for depth 1, 2, 3...
+PERFT_POSITIONS = [
+    ("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",                [20, 400, 8902, 197281, 4865609]),
+    ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",    [48, 2039, 97862, 4085603]),
+    ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",                               [14, 191, 2812, 43238, 674624]),
+    ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",        [6, 264, 9467, 422333]),
+    ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",               [44, 1486, 62379, 2103487]),
+]
+
+def perftMain(depth):
+    """
+    Runs perft on every reference position up to the depth given, printing node counts and speed.
+    Returns True if every count matched
+    
+    Keyword arguments:
+    depth -- the deepest search to run
+    """
+    
+    game = ChessGame()
+    passed = True
+    total_nodes = 0
+    total_time = 0.0
+    
+    for fen, expected in PERFT_POSITIONS:
+        game.setFEN(fen)
+        print(fen)
+        for d in range(1, min(depth, len(expected)) + 1):
+            start = time.time()
+            nodes = game.perft(d)
+            elapsed = time.time() - start
+            total_nodes += nodes
+            total_time += elapsed
+            
+            if nodes == expected[d-1]:
+                result = "Passed"
+            else:
+                result = "Failed (expected {})".format(expected[d-1])
+                passed = False
+            print("  depth {}: {:>9} nodes {:>8.3f}s {:>9.0f} nodes/s  {}".format(d, nodes, elapsed, nodes / max(elapsed, 1e-9), result))
+    
+    print("Total: {} nodes in {:.3f}s, {:.0f} nodes/s".format(total_nodes, total_time, total_nodes / max(total_time, 1e-9)))
+    return passed
+
+def readGames(lines):
+    """
+    Yields (line number, starting FEN or None, moves) for each game in a PGN file, or in a file with one move list per
+    line when the first line isn't a PGN tag
+    
+    Keyword arguments:
+    lines -- an iterable of the file's lines
+    """
+    
+    lines = pgn.readLines(lines)
+    # The blank lines skipped here still count towards the line numbers of the games after them
+    for number, first in enumerate(lines, 1):
+        if first.strip():
+            break
+    else:
+        return
+    
+    for game in pgn.readGames(itertools.chain([first], lines), lineGames=not first.lstrip().startswith("["),
+                              firstLine=number):
+        yield game.line, game.startFEN(), game.moves
+
+# The board and cache each validate worker process plays games on
+_validateGame = None
+_validateCache = None
+
+def _validateChunk(args):
+    """
+    Plays a chunk of games, returning (line number, URL or FEN, or False if the moves are invalid) for each
+    
+    Keyword arguments:
+    args -- a tuple of the list of (line number, starting FEN, moves) to play and "url" or "fen"
+    """
+    
+    global _validateGame, _validateCache
+    if _validateGame is None:
+        _validateGame = ChessGame()
+        _validateCache = MoveCache()
+    
+    games, output = args
+    results = []
+    for number, fen, moves in games:
+        if fen is None:
+            r = _validateGame.getLichessURL(" ".join(moves), _validateCache)
+        else:
+            r = _validateGame.setFEN(fen) != False and _validateGame.playMoves(moves)
+            if r != False:
+                _validateGame.getFEN()
+                r = _validateGame.analysisURL()
+        if r != False and output == "fen":
+            r = _validateGame.fen
+        results.append((number, r))
+    return results
+
+def validateMain(path, workers=1, output="url", chunkSize=200):
+    """
+    Checks every game in a PGN or one-game-per-line file, printing the final position of each and the speed.
+    Returns True if every game was valid
+    
+    Keyword arguments:
+    path      -- the file to read, - for stdin
+    workers   -- how many processes to play games in
+    output    -- "url" to print Lichess analysis URLs, "fen" to print FENs
+    chunkSize -- how many games to hand a worker at once
+    """
+    
+    games = 0
+    invalid = 0
+    start = time.time()
+    
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        def chunks():
+            read = readGames(f)
+            while True:
+                chunk = list(itertools.islice(read, chunkSize))
+                if not chunk:
+                    return
+                yield chunk, output
+        
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            # Only read a few chunks per worker ahead so big files aren't loaded whole
+            work = chunks()
+            def results():
+                while True:
+                    batch = list(itertools.islice(work, workers * 4))
+                    if not batch:
+                        return
+                    for result in pool.imap(_validateChunk, batch):
+                        yield result
+        else:
+            pool = None
+            results = lambda: itertools.imap(_validateChunk, chunks())
+        
+        for chunk in results():
+            for number, r in chunk:
+                games += 1
+                if r == False:
+                    invalid += 1
+                    print("{}: Invalid moves".format(number))
+                else:
+                    print("{}: {}".format(number, r))
+        
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    
+    elapsed = time.time() - start
+    sys.stderr.write("{} games, {} invalid in {:.3f}s, {:.0f} games/s\n".format(games, invalid, elapsed, games / max(elapsed, 1e-9)))
+    return invalid == 0
 
 def main(reactor, description):
     endpoint = endpoints.clientFromString(reactor, description)
     factory = ChessIRCFactory()
+    factory.publishMetrics()
+    factory.watchdog.start()
     d = endpoint.connect(factory)
     d.addCallback(lambda protocol: protocol.deferred)
     return d
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "perft":
+        # python ircbot.py perft [depth]
+        depth = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+        sys.exit(0 if perftMain(depth) else 1)
+    
+    if len(sys.argv) > 2 and sys.argv[1] == "validate":
+        # python ircbot.py validate <file> [workers] [url|fen]
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else multiprocessing.cpu_count()
+        output = sys.argv[4] if len(sys.argv) > 4 else "url"
+        sys.exit(0 if validateMain(sys.argv[2], workers, output) else 1)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == "openings":
+        # python ircbot.py openings [tsv] [index]
+        tsvPath = sys.argv[2] if len(sys.argv) > 2 else ChessIRCFactory.openingsFile
+        indexPath = sys.argv[3] if len(sys.argv) > 3 else ChessIRCFactory.openingsIndex
+        print("Wrote {} positions to {}".format(buildOpeningBook(tsvPath, indexPath), indexPath))
+        sys.exit(0)
+    
     game = ChessGame()
     
     print("##### Legal #####")
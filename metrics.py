@@ -0,0 +1,232 @@
+"""
+Counters, latency histograms and gauges, exported in the Prometheus text format
+
+Counters and histograms are recorded as things happen. Collectors are
+functions that return a dict of current values each time the metrics are
+rendered, so things like queue depths and cache stats don't have to be pushed
+anywhere. A collected value whose key ends in _total is a running count and is
+exported as a counter, anything else as a gauge.
+"""
+
+import os
+import time
+
+from twisted.python import failure
+from twisted.web import resource
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def formatLabels(labels, extra=None):
+    """
+    Returns labels in the {name="value",...} form, or an empty string if there aren't any
+
+    Keyword arguments:
+    labels -- a sorted tuple of (name, value) pairs
+    extra  -- one more (name, value) pair to add at the end, or None
+    """
+
+    pairs = list(labels)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Counts a value in the first bucket it fits in
+
+        Keyword arguments:
+        value -- the value to count, usually seconds
+        """
+
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Metrics(object):
+    """
+    Holds every metric by name and labels and renders them as Prometheus text
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        Keyword arguments:
+        clock -- returns the current time in seconds
+        """
+
+        self.clock = clock
+        # (name, labels) ---> value or Histogram, labels being a sorted tuple of (name, value)
+        self.counters = {}
+        self.histograms = {}
+        # name ---> help text
+        self.help = {}
+        # prefix ---> function returning a dict of metric name ---> value
+        self.collectors = {}
+
+    def describe(self, name, text):
+        """
+        Sets the help text shown for a metric
+
+        Keyword arguments:
+        name -- the metric's name
+        text -- what it measures
+        """
+
+        self.help[name] = text
+
+    def inc(self, name, labels=None, amount=1):
+        """
+        Adds to a counter
+
+        Keyword arguments:
+        name   -- the counter's name, ending in _total
+        labels -- a dict of label names to values, or None
+        amount -- how much to add
+        """
+
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=None):
+        """
+        Counts a value in a histogram
+
+        Keyword arguments:
+        name   -- the histogram's name
+        value  -- the value to count, usually seconds
+        labels -- a dict of label names to values, or None
+        """
+
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def timeDeferred(self, d, name, labels=None, errors=None):
+        """
+        Observes how long a Deferred takes to fire in a histogram, and counts it as an error if it fails. Returns the
+        Deferred
+
+        Keyword arguments:
+        d      -- the Deferred to time
+        name   -- the histogram's name
+        labels -- a dict of label names to values, or None
+        errors -- the counter to add to on failure, or None
+        """
+
+        start = self.clock()
+
+        def done(result):
+            self.observe(name, self.clock() - start, labels)
+            if errors is not None and isinstance(result, failure.Failure):
+                self.inc(errors, labels)
+            return result
+
+        d.addBoth(done)
+        return d
+
+    def addCollector(self, prefix, collect):
+        """
+        Adds a function whose values are exported named prefix_<key>, replacing any other with that prefix. Keys
+        ending in _total are exported as counters, so they should only ever go up, and the rest as gauges
+
+        Keyword arguments:
+        prefix  -- what to put in front of every metric name
+        collect -- called with no arguments, returns a dict of key ---> number
+        """
+
+        self.collectors[prefix] = collect
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format
+
+        Keyword arguments:
+        """
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            if name in self.help:
+                lines.append("# HELP {} {}".format(name, self.help[name]))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+        for name, labels in sorted(self.counters):
+            header(name, "counter")
+            lines.append("{}{} {}".format(name, formatLabels(labels), formatValue(self.counters[name, labels])))
+
+        for name, labels in sorted(self.histograms):
+            header(name, "histogram")
+            histogram = self.histograms[name, labels]
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, formatLabels(labels, ("le", formatValue(bound))), cumulative))
+            lines.append("{}_bucket{} {}".format(name, formatLabels(labels, ("le", "+Inf")), histogram.count))
+            lines.append("{}_sum{} {}".format(name, formatLabels(labels), formatValue(histogram.sum)))
+            lines.append("{}_count{} {}".format(name, formatLabels(labels), histogram.count))
+
+        for prefix in sorted(self.collectors):
+            values = self.collectors[prefix]()
+            for key in sorted(values):
+                name = "{}_{}".format(prefix, key)
+                header(name, "counter" if key.endswith("_total") else "gauge")
+                lines.append("{} {}".format(name, formatValue(values[key])))
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+        Writes the rendered metrics to a file, replacing it in one step so readers never see half of it
+
+        Keyword arguments:
+        path -- the file to write
+        """
+
+        with open(path + ".tmp", "w") as f:
+            f.write(self.render())
+        os.rename(path + ".tmp", path)
+
+
+class MetricsResource(resource.Resource):
+    """
+    Serves the rendered metrics, for Prometheus to scrape
+    """
+
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return self.metrics.render()
@@ -0,0 +1,135 @@
+"""
+Opening book index, memory-mapped from disk
+
+The index maps a position's Zobrist key to the ECO code and name of the
+opening it belongs to. It is an open addressing hash table written to a
+file, so a lookup reads one or two slots straight out of the mapped pages
+and nothing is loaded into Python objects up front. Worker processes that
+map the same file share its pages.
+
+File layout, all integers little endian:
+
+    header  MAGIC, slot count (uint32), depth (uint32), check key (uint64)
+    slots   slot count * (key uint64, offset uint32, length uint32)
+    names   "ECO<tab>name" strings the slots point at
+
+A slot with a length of 0 is empty. The check key is the key of a known
+position when the index was built, so an index made with different Zobrist
+keys can be noticed and rebuilt. The depth is the number of plies in the
+longest opening, past which a game can't reach a position in the book.
+"""
+
+import mmap
+import os
+import struct
+
+MAGIC = "CBOOK002"
+HEADER = struct.Struct("<8sIIQ")
+SLOT = struct.Struct("<QII")
+
+
+class OpeningBook(object):
+    def __init__(self, path):
+        """
+        Keyword arguments:
+        path -- the index file written by build()
+        """
+
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.slots, self.depth, self.check = HEADER.unpack_from(self.map, 0)
+        except struct.error:
+            self.map.close()
+            raise ValueError("{} is too short to be an opening book index".format(path))
+        # A truncated file would otherwise only fail when a lookup reached past its end
+        if magic != MAGIC or self.slots == 0 or self.slots & (self.slots - 1) or \
+                len(self.map) < HEADER.size + self.slots*SLOT.size:
+            self.map.close()
+            raise ValueError("{} isn't an opening book index".format(path))
+        self.mask = self.slots - 1
+
+    def find(self, key):
+        """
+        Returns the (ECO, name) of the opening with the position given, or None if it isn't in the book
+
+        Keyword arguments:
+        key -- the Zobrist key of the position
+        """
+
+        i = key & self.mask
+        while True:
+            slotKey, offset, length = SLOT.unpack_from(self.map, HEADER.size + i*SLOT.size)
+            if length == 0:
+                return None
+            if slotKey == key:
+                return tuple(self.map[offset:offset+length].split("\t", 1))
+            i = (i + 1) & self.mask
+
+    def close(self):
+        """
+        Unmaps the index
+
+        Keyword arguments:
+        """
+
+        self.map.close()
+
+
+def build(entries, path, check, depth):
+    """
+    Writes an index of the openings given, replacing the file in one step. The first name given for a position
+    is the one kept. Returns how many positions were written
+
+    Keyword arguments:
+    entries -- an iterable of (Zobrist key, ECO, name)
+    path    -- the file to write
+    check   -- the check key to store in the header
+    depth   -- the number of plies in the longest opening
+    """
+
+    names = {}
+    for key, eco, name in entries:
+        names.setdefault(key, "{}\t{}".format(eco, name))
+
+    # At most half full, so probes stay short
+    slots = 1
+    while slots < len(names) * 2:
+        slots <<= 1
+    mask = slots - 1
+
+    table = [None] * slots
+    offset = HEADER.size + slots*SLOT.size
+    text = []
+    for key in sorted(names):
+        i = key & mask
+        while table[i] is not None:
+            i = (i + 1) & mask
+        table[i] = (key, offset, len(names[key]))
+        text.append(names[key])
+        offset += len(names[key])
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, slots, depth, check))
+        for slot in table:
+            f.write(SLOT.pack(*slot) if slot is not None else SLOT.pack(0, 0, 0))
+        f.write("".join(text))
+    os.rename(path + ".tmp", path)
+    return len(names)
+
+
+def readTSV(path):
+    """
+    Yields (ECO, name, moves) for each opening in a tab separated file with eco, name and pgn columns, as in the
+    Lichess chess-openings files. The header line is skipped
+
+    Keyword arguments:
+    path -- the file to read
+    """
+
+    with open(path) as f:
+        for line in f:
+            parts = line.rstrip("\r\n").split("\t")
+            if len(parts) < 3 or parts[0] == "eco":
+                continue
+            yield parts[0], parts[1], parts[2]
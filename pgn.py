@@ -0,0 +1,184 @@
+"""
+Streaming PGN reader
+
+readGames() reads a PGN source one line at a time and yields each game as
+soon as its result has been read, so a database of any size can be gone
+through while holding only one game in memory. The source can be a file,
+an mmap, or any iterable of lines.
+"""
+
+import collections
+import re
+
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+
+TAG = re.compile(r'\[\s*(\w+)\s*"((?:[^"\\]|\\.)*)"\s*\]')
+TOKEN = re.compile(r'[{;()]|\$\d+|[^\s{;()$]+')
+MOVE_NUMBER = re.compile(r"^(?:\d+\.+|\d+$|\.+)")
+
+
+class PGNGame(object):
+    """
+    One game read from a PGN source. Comments, NAGs and variations are keyed by how many main line moves come
+    before them, so a variation stored under n replaces moves[n-1]
+    """
+
+    def __init__(self, line):
+        """
+        Keyword arguments:
+        line -- the line number the game starts on
+        """
+
+        self.line = line
+        self.headers = collections.OrderedDict()
+        self.moves = []
+        self.result = None
+        self.comments = {}
+        self.nags = {}
+        self.variations = {}
+
+    def startFEN(self):
+        """
+        Returns the FEN the game starts from, or None if it starts from the usual position
+
+        Keyword arguments:
+        """
+
+        return self.headers.get("FEN")
+
+    def annotate(self, table, value):
+        """
+        Adds a comment, NAG or variation to the ones found after the moves read so far
+
+        Keyword arguments:
+        table -- self.comments, self.nags or self.variations
+        value -- the annotation to add
+        """
+
+        table.setdefault(len(self.moves), []).append(value)
+
+
+def readLines(source):
+    """
+    Returns an iterator over the lines of a file, mmap or iterable of lines
+
+    Keyword arguments:
+    source -- where to read the lines from
+    """
+
+    if hasattr(source, "readline"):
+        # mmap objects can't be iterated over by line, but they can readline
+        return iter(source.readline, "")
+    return iter(source)
+
+
+def readGames(source, annotations=False, lineGames=False, firstLine=1):
+    """
+    Yields a PGNGame for each game in the source, reading no further ahead than the end of the game
+
+    Keyword arguments:
+    source      -- a file, mmap or iterable of lines
+    annotations -- True to keep comments, NAGs and variations, False to skip them
+    lineGames   -- True if every line is a game of its own, as in a file of pasted move lists
+    firstLine   -- the line number of the source's first line, for a source some lines have already been read from
+    """
+
+    game = None
+    # The pieces of a { } comment that runs over more than one line, or None
+    comment = None
+    # How deep inside variations we are, and the tokens of the one being kept
+    depth = 0
+    variation = []
+
+    for number, line in enumerate(readLines(source), firstLine):
+        pos = 0
+        if comment is not None:
+            end = line.find("}")
+            if end < 0:
+                comment.append(line.strip())
+                continue
+            comment.append(line[:end].strip())
+            if game is not None and annotations:
+                text = " ".join(a for a in comment if a)
+                if depth:
+                    variation.append("{" + text + "}")
+                else:
+                    game.annotate(game.comments, text)
+            comment = None
+            pos = end + 1
+
+        stripped = line.strip()
+        if pos == 0 and depth == 0 and stripped.startswith("["):
+            # A tag pair, which starts a new game if the last one has moves but no result
+            if game is not None and (game.moves or game.result is not None):
+                yield game
+                game = None
+            if game is None:
+                game = PGNGame(number)
+            match = TAG.match(stripped)
+            if match is not None:
+                game.headers[match.group(1)] = re.sub(r'\\(.)', r'\1', match.group(2))
+            continue
+        if pos == 0 and stripped.startswith("%"):
+            continue
+
+        while True:
+            match = TOKEN.search(line, pos)
+            if match is None:
+                break
+            token = match.group()
+            pos = match.end()
+            if game is None:
+                game = PGNGame(number)
+
+            if token == "{":
+                end = line.find("}", pos)
+                if end < 0:
+                    comment = [line[pos:].strip()]
+                    break
+                text = line[pos:end].strip()
+                pos = end + 1
+                if annotations:
+                    if depth:
+                        variation.append("{" + text + "}")
+                    else:
+                        game.annotate(game.comments, text)
+            elif token == ";":
+                if annotations and depth == 0:
+                    game.annotate(game.comments, line[pos:].strip())
+                break
+            elif token == "(":
+                depth += 1
+                if depth > 1:
+                    variation.append(token)
+            elif token == ")":
+                if depth == 0:
+                    continue
+                depth -= 1
+                if depth:
+                    variation.append(token)
+                else:
+                    if annotations:
+                        game.annotate(game.variations, " ".join(variation).replace("( ", "(").replace(" )", ")"))
+                    variation = []
+            elif depth:
+                if annotations:
+                    variation.append(token)
+            elif token[0] == "$":
+                if annotations:
+                    game.annotate(game.nags, int(token[1:]))
+            elif token in RESULTS:
+                game.result = token
+                yield game
+                game = None
+            else:
+                move = MOVE_NUMBER.sub("", token)
+                if move:
+                    game.moves.append(move)
+
+        if lineGames and game is not None and comment is None and depth == 0:
+            yield game
+            game = None
+
+    if game is not None and (game.moves or game.headers):
+        yield game
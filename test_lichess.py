@@ -0,0 +1,87 @@
+"""
+Tests for the Lichess lookups, run against a local twisted.web server that never answers
+
+    python -m twisted.trial test_lichess
+"""
+
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+import ircbot
+
+
+class SlowLichess(resource.Resource):
+    """
+    Holds every request open without answering it
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.waiting = []
+
+    def render_GET(self, request):
+        self.waiting.append(request)
+        return server.NOT_DONE_YET
+
+
+class LichessTimeoutTests(unittest.TestCase):
+    def setUp(self):
+        self.lichess = SlowLichess()
+        self.port = reactor.listenTCP(0, server.Site(self.lichess), interface="127.0.0.1")
+
+        self.factory = ircbot.ChessIRCFactory()
+        self.factory.lichessURL = "http://127.0.0.1:{}".format(self.port.getHost().port)
+        self.factory.lichessTimeout = 0.5
+
+        self.protocol = ircbot.ChessBotIRCProtocol()
+        self.protocol.factory = self.factory
+        self.protocol.nickname = "ChessBot"
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.protocol.sendQueue.stop()
+        yield self.factory.pool.closeCachedConnections()
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def waitFor(self, text, limit):
+        """
+        Waits until the bot has sent a message containing the text given, for at most limit seconds
+
+        Keyword arguments:
+        text  -- what to wait for in the bot's output
+        limit -- how long to wait
+        """
+
+        end = time.time() + limit
+        while text not in self.transport.value():
+            if time.time() > end:
+                self.fail("Nothing containing {!r} was sent: {!r}".format(text, self.transport.value()))
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_slowLookupTimesOut(self):
+        """
+        A Lichess request that gets no answer is cut off at lichessTimeout, and !board is answered while it waits
+        """
+
+        start = time.time()
+        self.protocol.privmsg("a!a@hostA", "ChessBot", "!live slow")
+        while not self.lichess.waiting:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+        self.protocol.privmsg("b!b@hostB", "##chess", "!board e4 e5")
+        self.assertIn("PRIVMSG ##chess :http://lichess.org/analysis/", self.transport.value())
+        self.assertNotIn("PRIVMSG a :", self.transport.value())
+
+        yield self.waitFor("PRIVMSG a :Couldn't reach Lichess.org, try again later", 5)
+        self.assertTrue(time.time() - start >= self.factory.lichessTimeout)
+        self.assertEqual(len(self.flushLoggedErrors(defer.TimeoutError)), 1)
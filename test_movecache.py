@@ -0,0 +1,43 @@
+"""
+Tests for MoveCache, the move-prefix trie behind !board
+
+    python -m twisted.trial test_movecache
+"""
+
+from twisted.trial import unittest
+
+import ircbot
+
+
+class MoveCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.game = ircbot.ChessGame()
+        self.cache = ircbot.MoveCache()
+
+    def nodes(self, children):
+        return sum(1 + self.nodes(node.children or {}) for node in children.values())
+
+    def test_malformedMoves(self):
+        """
+        A move that can't be parsed is illegal, and leaves every cached position where it can be evicted
+        """
+
+        for moves in ["e4 N*f3", "d4 d5 N*f3", "e4 =?", "e4 e5 Nz@3"]:
+            self.assertEqual(self.game.getLichessURL(moves, self.cache, []), False)
+        self.assertEqual(self.nodes(self.cache.root), self.cache.stats()["entries"])
+        self.assertEqual(self.cache.stats()["entries"], 4)
+
+    def test_pathRegisteredWhenMoveRaises(self):
+        """
+        Positions cached before a move raises are still in the LRU
+        """
+
+        def broken(move):
+            if move == "Nf3":
+                raise RuntimeError(move)
+            return ircbot.ChessGame.push(self.game, move)
+        self.game.push = broken
+
+        self.assertRaises(RuntimeError, self.cache.play, self.game, "e4 e5 Nf3")
+        self.assertEqual(self.nodes(self.cache.root), 2)
+        self.assertEqual(self.cache.stats()["entries"], 2)
@@ -0,0 +1,192 @@
+"""
+Tests for ResponseCache, the cache in front of the !live and !team lookups, run against a local twisted.web server
+standing in for the Lichess API
+
+    python -m twisted.trial test_responsecache
+"""
+
+import json
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+import ircbot
+
+
+class FakeLichess(resource.Resource):
+    """
+    Answers every request with the JSON or HTTP status set for its path, holding the answers back while held is True
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        # path ---> JSON to answer with, or an HTTP status code
+        self.answers = {}
+        # Every path requested, in order
+        self.requests = []
+        self.held = False
+        self.waiting = []
+
+    def render_GET(self, request):
+        self.requests.append(request.path)
+        if self.held:
+            self.waiting.append(request)
+        else:
+            self.answer(request)
+        return server.NOT_DONE_YET
+
+    def answer(self, request):
+        """
+        Finishes a request with the answer set for its path
+
+        Keyword arguments:
+        request -- the request to finish
+        """
+
+        answer = self.answers.get(request.path, 404)
+        if isinstance(answer, int):
+            request.setResponseCode(answer)
+            request.write("")
+        else:
+            request.write(json.dumps(answer))
+        request.finish()
+
+    def release(self):
+        """
+        Answers every request held back so far
+
+        Keyword arguments:
+        """
+
+        self.held = False
+        waiting, self.waiting = self.waiting, []
+        for request in waiting:
+            self.answer(request)
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.lichess = FakeLichess()
+        self.port = reactor.listenTCP(0, server.Site(self.lichess), interface="127.0.0.1")
+
+        self.factory = ircbot.ChessIRCFactory()
+        self.factory.lichessURL = "http://127.0.0.1:{}".format(self.port.getHost().port)
+        # The cache's idea of time is moved by hand, the requests themselves go over the real reactor
+        self.clock = task.Clock()
+        self.factory.lichessCache = ircbot.ResponseCache(10, clock=self.clock)
+
+        self.protocol = ircbot.ChessBotIRCProtocol()
+        self.protocol.factory = self.factory
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        # An error answer's body is thrown away after the result fires, so its connection only goes back to the
+        # pool on a later turn of the reactor
+        yield task.deferLater(reactor, 0, lambda: None)
+        yield self.factory.pool.closeCachedConnections()
+        yield self.port.stopListening()
+
+    def get(self, path, ttl=30):
+        return self.protocol.getJSONCached(path, ttl, "test")
+
+    @defer.inlineCallbacks
+    def test_hitUntilExpiry(self):
+        """
+        A result is reused until its time to live has passed, and fetched again after
+        """
+
+        self.lichess.answers["/api/user/a"] = {"id": "a"}
+
+        first = yield self.get("/api/user/a")
+        self.clock.advance(29)
+        second = yield self.get("/api/user/a")
+        self.assertEqual(first, {"id": "a"})
+        self.assertEqual(second, first)
+        self.assertEqual(self.lichess.requests, ["/api/user/a"])
+
+        self.lichess.answers["/api/user/a"] = {"id": "a", "playing": "http://lichess.org/abc"}
+        self.clock.advance(2)
+        third = yield self.get("/api/user/a")
+        self.assertEqual(third["playing"], "http://lichess.org/abc")
+        self.assertEqual(len(self.lichess.requests), 2)
+
+        stats = self.factory.lichessCache.stats()
+        self.assertEqual((stats["hits_total"], stats["misses_total"]), (1, 2))
+
+    @defer.inlineCallbacks
+    def test_coalesceConcurrentRequests(self):
+        """
+        Requests for a path that is already being fetched wait on that fetch instead of making their own
+        """
+
+        self.lichess.answers["/api/user/b"] = {"id": "b"}
+        self.lichess.held = True
+
+        waiters = [self.get("/api/user/b") for _ in range(3)]
+        # Let the one real request reach the server before answering it
+        while not self.lichess.waiting:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.lichess.release()
+
+        results = yield defer.gatherResults(waiters)
+        self.assertEqual(results, [{"id": "b"}] * 3)
+        self.assertEqual(self.lichess.requests, ["/api/user/b"])
+        self.assertEqual(self.factory.lichessCache.stats()["coalesced_total"], 2)
+
+    @defer.inlineCallbacks
+    def test_failuresAreNotCached(self):
+        """
+        An error is passed to everyone waiting on the fetch, and the next request tries Lichess again
+        """
+
+        self.lichess.answers["/api/user/c"] = 500
+        self.lichess.held = True
+
+        waiters = [self.get("/api/user/c") for _ in range(2)]
+        while not self.lichess.waiting:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.lichess.release()
+
+        for d in waiters:
+            yield self.assertFailure(d, ircbot.LichessError)
+
+        self.lichess.answers["/api/user/c"] = {"id": "c"}
+        result = yield self.get("/api/user/c")
+        self.assertEqual(result, {"id": "c"})
+        self.assertEqual(len(self.lichess.requests), 2)
+        self.assertEqual(self.factory.lichessCache.stats()["entries"], 1)
+
+    @defer.inlineCallbacks
+    def test_missingPathIsCached(self):
+        """
+        A 404 is an answer, not an error: it comes back as None and is cached like any other result
+        """
+
+        first = yield self.get("/api/user/nobody")
+        second = yield self.get("/api/user/nobody")
+        self.assertIdentical(first, None)
+        self.assertIdentical(second, None)
+        self.assertEqual(self.lichess.requests, ["/api/user/nobody"])
+
+    @defer.inlineCallbacks
+    def test_leastRecentlyUsedEvicted(self):
+        """
+        Once the cache is full the result used longest ago is dropped, and a hit counts as a use
+        """
+
+        for a in range(11):
+            self.lichess.answers["/api/user/{}".format(a)] = {"id": a}
+        for a in range(10):
+            yield self.get("/api/user/{}".format(a))
+        yield self.get("/api/user/0")
+        yield self.get("/api/user/10")
+
+        stats = self.factory.lichessCache.stats()
+        self.assertEqual((stats["entries"], stats["evictions_total"]), (10, 1))
+        yield self.get("/api/user/0")
+        yield self.get("/api/user/1")
+        self.assertEqual(self.lichess.requests.count("/api/user/0"), 1)
+        self.assertEqual(self.lichess.requests.count("/api/user/1"), 2)
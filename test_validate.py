@@ -0,0 +1,57 @@
+"""
+Tests for the bulk game validator behind python ircbot.py validate
+
+    python -m twisted.trial test_validate
+"""
+
+from twisted.trial import unittest
+
+import ircbot
+
+
+class ReadGamesTests(unittest.TestCase):
+    def numbers(self, text):
+        return [number for number, fen, moves in ircbot.readGames(text.splitlines(True))]
+
+    def test_moveListLineNumbers(self):
+        """
+        Blank lines before the first move list still count towards the line numbers of the games
+        """
+
+        self.assertEqual(self.numbers("\n\n\ne4 e5\nd4 Qh4\n"), [4, 5])
+
+    def test_pgnLineNumbers(self):
+        """
+        Blank lines before the first tag still count towards the line numbers of the games
+        """
+
+        text = ('\n\n[Event "a"]\n\n1. e4 e5 1-0\n\n[Event "b"]\n\n1. d4 d5 0-1\n')
+        self.assertEqual(self.numbers(text), [3, 7])
+
+    def test_emptyFile(self):
+        """
+        A file of nothing but blank lines has no games in it
+        """
+
+        self.assertEqual(self.numbers("\n \n\n"), [])
+
+
+class ValidateChunkTests(unittest.TestCase):
+    def test_castlingWithZeros(self):
+        """
+        Castling written as 0-0 is played whether or not the game starts from a FEN tag
+        """
+
+        moves = ["e4", "e5", "Nf3", "Nc6", "Bc4", "Nf6", "0-0"]
+        results = ircbot._validateChunk(([(1, None, moves), (2, ircbot.ChessGame.fen_startpos, moves)], "fen"))
+        self.assertEqual(results[0][1], "r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQ1RK1 b kq - 5 4")
+        self.assertEqual(results[1][1], results[0][1])
+
+    def test_moveNumbersAndResults(self):
+        """
+        Move numbers and results in a move list aren't taken for moves
+        """
+
+        game = ircbot.ChessGame()
+        self.assertEqual(game.moveSplit("1. e4 e5 2. 0-0+ 0-0-0 12... Nf6 0-1 1-0 1/2-1/2"),
+                         ["e4", "e5", "0-0+", "0-0-0", "Nf6"])